@@ -1,11 +1,106 @@
 """CDNAPI version 1.0.0 initialization package."""
 
+import os
+
 from flask import Flask
-from flask_thumbnails import Thumbnail
 
 app = Flask(__name__)
 app.config.from_object('config')
 
-thumbnail = Thumbnail(app)
+app.config.setdefault('INDEX_FOLDER', '.index')
+app.config.setdefault('METADATA_INDEX_FILE', os.path.join(
+    app.config['ROOT_PATH'],
+    app.config['INDEX_FOLDER'],
+    'metadata.sqlite3'
+))
+app.config.setdefault('DIRECTORY_SIZE_TTL', 300)
+app.config.setdefault('LISTING_INDEX_SIZE', 128)
+app.config.setdefault('METADATA_WORKERS', 4)
+# Один запрос занимает не больше половины общего пула
+app.config.setdefault(
+    'METADATA_REQUEST_WORKERS',
+    max(1, app.config['METADATA_WORKERS'] // 2)
+)
+app.config.setdefault('RENDER_CACHE_FOLDER', '.renders')
+app.config.setdefault('RENDER_CACHE_ROOT', os.path.join(
+    app.config['ROOT_PATH'],
+    app.config['RENDER_CACHE_FOLDER']
+))
+app.config.setdefault('RENDER_CACHE_MAX_SIZE', 1024 * 1024 * 1024)
+app.config.setdefault('WATERMARK_CACHE_MAX_SIZE', 64 * 1024 * 1024)
+app.config.setdefault('THUMBNAIL_MAX_DECODE_PIXELS', 32 * 1000 * 1000)
+app.config.setdefault('IMAGE_NEGOTIATED_FORMATS', ['AVIF', 'WEBP'])
+app.config.setdefault('THUMBNAIL_PRESETS', [])
+app.config.setdefault('THUMBNAIL_QUEUE_FILE', os.path.join(
+    app.config['ROOT_PATH'],
+    app.config['INDEX_FOLDER'],
+    'thumbnails.sqlite3'
+))
+app.config.setdefault('THUMBNAIL_QUEUE_WORKERS', 2)
+app.config.setdefault('LOCKS_ROOT', os.path.join(
+    app.config['ROOT_PATH'],
+    app.config['INDEX_FOLDER'],
+    'locks'
+))
+app.config.setdefault('FILE_DELIVERY_BACKEND', 'wsgi')
+app.config.setdefault('FILE_DELIVERY_ACCEL_ROOT', '/protected/')
+app.config.setdefault('MAX_BYTE_RANGES', 16)
+app.config.setdefault('BATCH_METADATA_MAX_PATHS', 10000)
+app.config.setdefault('FILESYSTEM_WATCHER', None)
+app.config.setdefault('SEARCH_INDEX_FILE', os.path.join(
+    app.config['ROOT_PATH'],
+    app.config['INDEX_FOLDER'],
+    'search.sqlite3'
+))
+app.config.setdefault('FILESYSTEM_WATCHER_INTERVAL', 5)
+app.config.setdefault('UPLOADS_INDEX_FILE', os.path.join(
+    app.config['ROOT_PATH'],
+    app.config['INDEX_FOLDER'],
+    'uploads.sqlite3'
+))
+app.config.setdefault('UPLOADS_ROOT', os.path.join(
+    app.config['ROOT_PATH'],
+    app.config['INDEX_FOLDER'],
+    'uploads'
+))
+app.config.setdefault('UPLOAD_SESSION_TTL', 24 * 60 * 60)
+app.config.setdefault('JSON_BACKEND', 'auto')
+app.config.setdefault(
+    'THUMBNAIL_STORAGE_BACKEND',
+    'app.classes.AtomicFilesystemStorageBackend'
+)
+
+from app.classes import ReducedThumbnail, ThumbnailQueue, SearchIndex, \
+    FileSystemWatcher, metadata_index, directory_sizes, render_cache  # noqa
+from app.utils import service_paths, supported_image_formats  # noqa
+
+thumbnail = ReducedThumbnail(app)
+thumbnail_queue = ThumbnailQueue(
+    app.config['THUMBNAIL_QUEUE_FILE'],
+    thumbnail,
+    presets=app.config['THUMBNAIL_PRESETS'],
+    # Форматы, выбираемые по «Accept», тоже создаются заранее
+    formats=[
+        f for f in app.config['IMAGE_NEGOTIATED_FORMATS']
+        if f in supported_image_formats()
+    ],
+    workers=app.config['THUMBNAIL_QUEUE_WORKERS']
+)
+# Служебные директории не индексируются и не отслеживаются
+search_index = SearchIndex(
+    app.config['SEARCH_INDEX_FILE'],
+    ignored=service_paths()
+)
+
+# Кэши производных данных сбрасываются при изменениях в обход API
+filesystem_watcher = FileSystemWatcher(
+    app.config['ROOT_PATH'],
+    [metadata_index, directory_sizes, render_cache, thumbnail, search_index],
+    ignored=service_paths(),
+    backend=app.config['FILESYSTEM_WATCHER'] or 'auto',
+    interval=app.config['FILESYSTEM_WATCHER_INTERVAL'],
+    # Дерево отслеживает только один процесс
+    lock_path=os.path.join(app.config['LOCKS_ROOT'], 'watcher.lock')
+)
 
 from app import api  # noqa
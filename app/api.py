@@ -3,23 +3,48 @@
 
 import os
 import pathlib
-import shutil
+import re
 import uuid
 
-from app import app, thumbnail
+from app import app, thumbnail, thumbnail_queue, filesystem_watcher, \
+    search_index
+from bisect import bisect_left, bisect_right
+from datetime import datetime
 from distutils.util import strtobool
-from operator import itemgetter
 
-from app.classes import FileSystemObject
-from app.utils import json_http_response, pagination_of_list, add_watermark
+from app.classes import FileSystemObject, ListingQuery, directory_sizes, \
+    listing_index, metadata_index, render_cache, upload_sessions
+from app.utils import json_http_response, pagination_data, sorted_head, \
+    cursor_pagination_data, encode_cursor, decode_cursor, query_limit, \
+    keyset_page, json_stream, json_document, json_dumps, ordered_map, \
+    save_with_hash, entity_tag, query_fields, \
+    last_modified_time, not_modified_response, conditional_headers, \
+    negotiate_image_format, supported_image_formats, IMAGE_FORMATS, \
+    add_watermark, deliver_file, service_paths, is_service_path
 
 from flask import Response, json, redirect, request, \
-    send_from_directory, url_for, send_file
+    send_from_directory, url_for, stream_with_context
 
 from flask_thumbnails.utils import parse_size
+from werkzeug.http import parse_content_range_header
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
 
 
+@app.before_first_request
+def start_thumbnail_queue():
+    """Start thumbnails pre-generation (finish jobs left in queue)."""
+    if app.config['THUMBNAIL_PRESETS']:
+        thumbnail_queue.start()
+
+
+@app.before_first_request
+def start_filesystem_watcher():
+    """Start watching changes made outside of API (if enabled)."""
+    if app.config['FILESYSTEM_WATCHER']:
+        filesystem_watcher.start()
+
+
 @app.route('/favicon.ico')
 def favicon():
     """Get favicon for dev version."""
@@ -56,11 +81,58 @@ def get_file(asked_file_path=''):
             is_directory = os.path.isdir(file_real_path)
             if is_directory:
 
+                hash_query = request.args.get('hash', None)
+                if hash_query is not None:
+                    hash_query = hash_query.lower()
+                    if not re.fullmatch('[0-9a-f]{128}', hash_query):
+                        return json_http_response(
+                            status=400,
+                            given_message='Your «hash» parameter is invalid '
+                            '(must be SHA-512 hex digest)!',
+                            dbg=request.args.get('dbg', False)
+                        )
+                    files_list = [
+                        FileSystemObject(p).get_metadata()
+                        for p in metadata_index.find(
+                            hash_query,
+                            file_real_path
+                        )
+                        if not is_service_path(p)
+                    ]
+                    return Response(
+                        response=json_dumps(
+                            {
+                                'hash': hash_query,
+                                'itemsCount': len(files_list),
+                                'filesList': files_list
+                            }
+                        ),
+                        status=200,
+                        mimetype='application/json'
+                    )
+
+                # Слабый ETag списка: время изменения директории и параметры
+                directory_stat = os.stat(file_real_path)
+                listing_etag = entity_tag(
+                    directory_stat.st_mtime_ns,
+                    request.host_url,
+                    request.query_string.decode('utf-8'),
+                    request.headers.get('Accept', '')
+                )
+                listing_modified = last_modified_time(directory_stat)
+                not_modified = not_modified_response(
+                    listing_etag,
+                    listing_modified,
+                    weak=True
+                )
+                if not_modified is not None:
+                    return not_modified
+
                 search_query = request.args.get('q', None)
                 if search_query:
                     try:
                         search_params_all = dict(
-                            e.split(':') for e in search_query.split(' ')
+                            e.split(':', 1) for e in search_query.split(' ')
                         )
                     except Exception:
                         return json_http_response(
@@ -86,7 +158,27 @@ def get_file(asked_file_path=''):
                 else:
                     search_params = None
 
-                files = []
+                ndjson_mode = request.accept_mimetypes.best_match(
+                    ('application/json', 'application/x-ndjson')
+                ) == 'application/x-ndjson'
+                stream_mode = request.args.get('stream', ndjson_mode)
+                if not isinstance(stream_mode, bool):
+                    try:
+                        stream_mode = strtobool(stream_mode)
+                    except Exception:
+                        return json_http_response(
+                            status=400,
+                            given_message='Your «stream» parameter is '
+                            'invalid (must be boolean value)!',
+                            dbg=request.args.get('dbg', False)
+                        )
+
+                fields_params, fields_info = query_fields(
+                    request.args,
+                    FileSystemObject.fields
+                )
+
+                rows = []
                 if asked_file_path:
                     partial_asked_file_path = '/'.join(
                         asked_file_path.split('/')[:-1]
@@ -100,20 +192,6 @@ def get_file(asked_file_path=''):
                 else:
                     parent_directory = 'This is root directory!'
 
-                for filename in os.listdir(file_real_path):
-                    file_path = os.path.join(file_real_path, filename)
-
-                    metadata = FileSystemObject(file_path).get_metadata()
-
-                    if search_params:
-                        if all(
-                            True if val in metadata.get(key, None) else False
-                            for key, val in search_params.items()
-                        ):
-                            files.append(metadata)
-                    else:
-                        files.append(metadata)
-
                 sorting_query = request.args.get('sf', None)
                 sorting_order = request.args.get('so', None)
 
@@ -153,25 +231,150 @@ def get_file(asked_file_path=''):
                 else:
                     sorting_params = ['name']
 
-                sorted_files = sorted(
-                    files,
-                    key=itemgetter(*sorting_params),
-                    reverse=sorting_reverse
-                )
+                # Постраничный вывод по курсору: ключ сортировки дополняется
+                # именем, чтобы порядок был полным и стабильным
+                cursor = request.args.get('cursor', None)
+                if cursor is not None:
+                    key_fields = sorting_params + (
+                        ['name'] if 'name' not in sorting_params else []
+                    )
+                    cursor_key = None
+                    if cursor:
+                        try:
+                            cursor_fields, cursor_reverse, cursor_key = \
+                                decode_cursor(cursor)
+                            cursor_key = tuple(cursor_key)
+                        except Exception:
+                            return json_http_response(
+                                status=400,
+                                given_message="Incorrect value of parameter "
+                                "'cursor'",
+                                dbg=request.args.get('dbg', False)
+                            )
+                        if cursor_fields != key_fields or \
+                                cursor_reverse != sorting_reverse:
+                            return json_http_response(
+                                status=400,
+                                given_message="Parameter 'cursor' doesn't "
+                                "match sorting parameters 'sf' and 'so'",
+                                dbg=request.args.get('dbg', False)
+                            )
+                    limit = query_limit(request.args)
+                    use_listing_index = key_fields == ['name'] and \
+                        not search_params
+                else:
+                    key_fields = sorting_params
+                    use_listing_index = False
 
-                paginated_data = pagination_of_list(
-                    sorted_files,
-                    url_for(
-                        '.get_file',
-                        asked_file_path=asked_file_path,
-                        _external=True
-                    ),
-                    query_params=request.args
+                # Поиск и сортировка компилируются один раз в типизированные
+                # условия и составной ключ
+                try:
+                    query = ListingQuery(search_params, key_fields)
+                except (ValueError, re.error):
+                    return json_http_response(
+                        status=400,
+                        given_message="Incorrect value of parameter 'q' "
+                        "(see supported values of fields in documentation)",
+                        dbg=request.args.get('dbg', False)
+                    )
+
+                # Служебные директории в листинг не попадают
+                hidden_names = {
+                    os.path.basename(p) for p in service_paths()
+                    if os.path.dirname(p) == os.path.normpath(file_real_path)
+                }
+
+                # Объекты ленивые: фильтрация и сортировка вычисляют только
+                # свои поля, полные метаданные строятся для одной страницы
+                if not use_listing_index:
+                    with os.scandir(file_real_path) as entries:
+                        files = [
+                            FileSystemObject(entry.path, entry=entry)
+                            for entry in entries
+                            if entry.name not in hidden_names
+                        ]
+
+                    # Строки из полей поиска и сортировки считаются
+                    # параллельно
+                    rows = list(ordered_map(query.row, files))
+                    if search_params:
+                        rows = [r for r in rows if query.matches(r)]
+
+                listing_url = url_for(
+                    '.get_file',
+                    asked_file_path=asked_file_path,
+                    _external=True
                 )
 
+                if cursor is None:
+                    paginated_data = pagination_data(
+                        len(rows),
+                        listing_url,
+                        query_params=request.args
+                    )
+                    page_start = paginated_data['start'] - 1
+                    page_end = page_start + paginated_data['limit']
+
+                    page = [r[-1] for r in sorted_head(
+                        rows,
+                        key=query.sort_key,
+                        reverse=sorting_reverse,
+                        count=page_end
+                    )[page_start:page_end]]
+                else:
+                    if use_listing_index:
+                        # Сортировка по имени: страница берется бинарным
+                        # поиском по отсортированному списку директории
+                        names = listing_index.names(file_real_path)
+                        if hidden_names:
+                            names = [
+                                n for n in names if n not in hidden_names
+                            ]
+                        items_count = len(names)
+                        if sorting_reverse:
+                            page_end = len(names) if cursor_key is None \
+                                else bisect_left(names, cursor_key[0])
+                            page_start = max(0, page_end - limit)
+                            page_names = names[page_start:page_end][::-1]
+                            has_more = page_start > 0
+                        else:
+                            page_start = 0 if cursor_key is None \
+                                else bisect_right(names, cursor_key[0])
+                            page_end = page_start + limit
+                            page_names = names[page_start:page_end]
+                            has_more = page_end < len(names)
+                        page = [
+                            FileSystemObject(
+                                os.path.join(file_real_path, name)
+                            )
+                            for name in page_names
+                        ]
+                    else:
+                        items_count = len(rows)
+                        page_rows, has_more = keyset_page(
+                            rows,
+                            key=query.sort_key,
+                            after=cursor_key,
+                            limit=limit,
+                            reverse=sorting_reverse
+                        )
+                        page = [r[-1] for r in page_rows]
+                    next_cursor = encode_cursor([
+                        key_fields,
+                        sorting_reverse,
+                        list(query.sort_key(query.row(page[-1])))
+                    ]) if has_more and page else None
+                    paginated_data = cursor_pagination_data(
+                        items_count,
+                        limit,
+                        cursor,
+                        next_cursor,
+                        listing_url,
+                        query_params=request.args
+                    )
+
                 response_obj = {
                     'parentDirectory': parent_directory,
-                    'filesList': paginated_data.pop('results'),
                     'paginationData': paginated_data
                 }
 
@@ -199,12 +402,50 @@ def get_file(asked_file_path=''):
                     sorting_params['sortingDirection'] = 'Desc' \
                         if sorting_reverse else 'Asc'
                     response_obj['sortingParams'] = sorting_params
+                if fields_info:
+                    response_obj['fieldsParams'] = fields_info
+
+                # Метаданные страницы считаются параллельно с сохранением
+                # порядка записей
+                files_metadata = (
+                    f.get_metadata(fields_params) for f in ordered_map(
+                        lambda f: f.prefetch(fields_params),
+                        page
+                    )
+                )
 
-                return Response(
-                    response=json.dumps(response_obj, ensure_ascii=False),
+                if stream_mode:
+                    # Каждая запись отправляется сразу после вычисления
+                    # метаданных, данные пагинации дублируются в заголовке
+                    return conditional_headers(Response(
+                        response=stream_with_context(json_stream(
+                            response_obj,
+                            'filesList',
+                            files_metadata,
+                            ndjson=ndjson_mode
+                        )),
+                        status=200,
+                        mimetype='application/x-ndjson' if ndjson_mode
+                        else 'application/json',
+                        headers={
+                            # Заголовки передаются в latin-1, поэтому
+                            # JSON в них только ASCII
+                            'X-Pagination-Data': json.dumps(
+                                paginated_data,
+                                ensure_ascii=True
+                            )
+                        }
+                    ), listing_etag, listing_modified, weak=True)
+
+                return conditional_headers(Response(
+                    response=json_document(
+                        response_obj,
+                        'filesList',
+                        files_metadata
+                    ),
                     status=200,
                     mimetype='application/json'
-                )
+                ), listing_etag, listing_modified, weak=True)
             else:
                 try:
                     original = os.path.join(
@@ -212,6 +453,30 @@ def get_file(asked_file_path=''):
                         asked_file_path
                     )
 
+                    # Сильный ETag файла: inode, размер и время изменения
+                    # (не хэш из индекса: он появляется позже, и тег бы
+                    # сменился у неизмененного файла); для производных
+                    # изображений к нему добавляются параметры запроса
+                    original_stat = os.stat(original)
+                    file_etag = '%x-%x-%x' % (
+                        original_stat.st_ino,
+                        original_stat.st_size,
+                        original_stat.st_mtime_ns
+                    )
+                    if request.args:
+                        file_etag = entity_tag(
+                            file_etag,
+                            request.query_string.decode('utf-8'),
+                            request.headers.get('Accept', '')
+                        )
+                    file_modified = last_modified_time(original_stat)
+                    not_modified = not_modified_response(
+                        file_etag,
+                        file_modified
+                    )
+                    if not_modified is not None:
+                        return not_modified
+
                     make_thumbnail = request.args.get('thumbnail', False)
                     make_watermark = request.args.get('watermark', False)
 
@@ -220,7 +485,7 @@ def get_file(asked_file_path=''):
                             make_thumbnail = strtobool(make_thumbnail)
                         except Exception:
                             return Response(
-                                response=json.dumps(
+                                response=json_dumps(
                                     {
                                         'responseType': 'Error',
                                         'status': 400,
@@ -238,7 +503,7 @@ def get_file(asked_file_path=''):
                             make_watermark = strtobool(make_watermark)
                         except Exception:
                             return Response(
-                                response=json.dumps(
+                                response=json_dumps(
                                     {
                                         'responseType': 'Error',
                                         'status': 400,
@@ -251,6 +516,37 @@ def get_file(asked_file_path=''):
                                 mimetype='application/json'
                             )
 
+                    # Формат производных изображений: из параметра «format»
+                    # или по заголовку «Accept»
+                    output_format = None
+                    output_quality = None
+                    if make_thumbnail or make_watermark:
+                        try:
+                            output_format = negotiate_image_format(
+                                request.args.get('format', None)
+                            )
+                        except ValueError:
+                            return json_http_response(
+                                status=400,
+                                given_message='Your «format» parameter is '
+                                'invalid (must be one of: %s)!' % (
+                                    ', '.join(supported_image_formats())
+                                )
+                            )
+                        try:
+                            output_quality = request.args.get('quality', None)
+                            if output_quality is not None:
+                                output_quality = int(output_quality)
+                                if output_quality < 1 or output_quality > 100:
+                                    raise ValueError(output_quality)
+                        except Exception:
+                            return json_http_response(
+                                status=400,
+                                given_message='Your «quality» parameter is '
+                                'invalid (must be integer number in 1 to 100 '
+                                'interval)!'
+                            )
+
                     if make_thumbnail:
 
                         thumbnail_size = request.args.get('size', None)
@@ -261,7 +557,7 @@ def get_file(asked_file_path=''):
                                 parse_size(thumbnail_size)
                             except Exception:
                                 return Response(
-                                    response=json.dumps(
+                                    response=json_dumps(
                                         {
                                             'responseType': 'Error',
                                             'status': 400,
@@ -285,7 +581,7 @@ def get_file(asked_file_path=''):
                                     thumbnail_crop = 'sized'
                             except Exception:
                                 return Response(
-                                    response=json.dumps(
+                                    response=json_dumps(
                                         {
                                             'responseType': 'Error',
                                             'status': 400,
@@ -302,10 +598,19 @@ def get_file(asked_file_path=''):
                             original,
                             app.config['ROOT_PATH']
                         )
+                        # Под водяной знак миниатюра создается в формате
+                        # оригинала, выходной формат применяется к результату
+                        thumbnail_options = {}
+                        if not make_watermark:
+                            if output_format is not None:
+                                thumbnail_options['format'] = output_format
+                            if output_quality is not None:
+                                thumbnail_options['quality'] = output_quality
                         thumbnail_link = thumbnail.get_thumbnail(
                             original_relpath,
                             size=thumbnail_size,
-                            crop=thumbnail_crop
+                            crop=thumbnail_crop,
+                            **thumbnail_options
                         )
                         thumbnail_path, thumbnail_filename = os.path.split(
                             thumbnail_link
@@ -319,6 +624,18 @@ def get_file(asked_file_path=''):
                             original_relpath_path
                         )
                         filename = thumbnail_filename
+                        # Миниатюра не создается для файлов, которые не
+                        # удалось открыть или которые слишком велики
+                        if not os.path.isfile(
+                            os.path.join(directory, filename)
+                        ):
+                            return json_http_response(
+                                status=400,
+                                given_message='Thumbnail can`t be created '
+                                'for this file (it is not an image or it is '
+                                'too large)!',
+                                dbg=request.args.get('dbg', False)
+                            )
                     else:
                         directory = app.config['ROOT_PATH']
                         filename = asked_file_path
@@ -352,23 +669,77 @@ def get_file(asked_file_path=''):
                                 'integer number value)!'
                             )
                         image_path = os.path.join(directory, filename)
+                        render_key = (
+                            'watermark',
+                            wm_opacity,
+                            wm_interval,
+                            wm_size,
+                            wm_angle,
+                            wm_x,
+                            wm_y,
+                            thumbnail_size if make_thumbnail else None,
+                            thumbnail_crop if make_thumbnail else None,
+                            output_format,
+                            output_quality
+                        )
+                        watermark_format = output_format or 'JPEG'
+                        mimetype, extension = IMAGE_FORMATS[watermark_format]
                         try:
-                            marked_image = add_watermark(
+                            marked_image = render_cache.get_or_render(
+                                original,
+                                render_key,
+                                lambda: add_watermark(
                                     image_path,
                                     wm_opacity=wm_opacity,
                                     wm_interval=wm_interval,
                                     wm_size=wm_size,
                                     wm_angle=wm_angle,
                                     wm_x=wm_x,
-                                    wm_y=wm_y
-                                )
+                                    wm_y=wm_y,
+                                    image_format=watermark_format,
+                                    quality=output_quality
+                                ).getvalue(),
+                                extension
+                            )
                         except Exception as error:
-                            return error.args[0]
-                        return send_file(marked_image, mimetype="image/jpeg")
+                            # Ошибки параметров и изображения содержат
+                            # готовый ответ 400
+                            if error.args and \
+                                    isinstance(error.args[0], Response):
+                                return error.args[0]
+                            return json_http_response(
+                                dbg=request.args.get('dbg', False)
+                            )
+                        response = deliver_file(
+                            marked_image,
+                            mimetype,
+                            file_etag,
+                            file_modified
+                        )
+                        response.vary.add('Accept')
+                        return conditional_headers(
+                            response,
+                            file_etag,
+                            file_modified
+                        )
 
-                    return send_from_directory(
-                        directory=directory,
-                        filename=filename
+                    file_path = safe_join(directory, filename)
+                    if file_path is None:
+                        return json_http_response(status=404)
+                    # Путь уже проверен, отдачу берет на себя сервер
+                    response = deliver_file(
+                        file_path,
+                        IMAGE_FORMATS[output_format][0]
+                        if output_format else None,
+                        file_etag,
+                        file_modified
+                    )
+                    if make_thumbnail:
+                        response.vary.add('Accept')
+                    return conditional_headers(
+                        response,
+                        file_etag,
+                        file_modified
                     )
                 except IOError as e:
                     return json_http_response(status=500, given_message=e)
@@ -378,6 +749,272 @@ def get_file(asked_file_path=''):
         return json_http_response(dbg=request.args.get('dbg', False))
 
 
+@app.route('/files/_batch/metadata', methods=['POST'])
+def get_batch_metadata():
+    """
+    Get metadata of many files and directories in one request.
+
+    Method takes json body {"paths": [...]} with paths relative to root
+    directory and optional «fields» parameter as in files list. Metadata is
+    computed in parallel keeping order of paths, not found paths are listed
+    separately.
+    """
+    try:
+        request_data = request.get_json(silent=True)
+        paths = request_data.get('paths', None) \
+            if isinstance(request_data, dict) else request_data
+        if not isinstance(paths, list) or \
+                not all(isinstance(p, str) for p in paths):
+            return json_http_response(
+                status=400,
+                given_message="You should send json body with «paths» list "
+                "of strings!",
+                dbg=request.args.get('dbg', False)
+            )
+        if len(paths) > app.config['BATCH_METADATA_MAX_PATHS']:
+            return json_http_response(
+                status=400,
+                given_message="Too many paths (maximum is %s)!" % (
+                    app.config['BATCH_METADATA_MAX_PATHS']
+                ),
+                dbg=request.args.get('dbg', False)
+            )
+
+        fields_params, fields_info = query_fields(
+            request.args,
+            FileSystemObject.fields
+        )
+
+        def batch_object(real_path):
+            """Get object with computed fields or None if it doesn`t exist."""
+            if real_path is None:
+                return None
+            try:
+                stat = os.stat(real_path)
+            except OSError:
+                return None
+            return FileSystemObject(real_path, stat=stat).prefetch(
+                fields_params
+            )
+
+        # Повторяющиеся пути вычисляются один раз
+        unique_paths = list(dict.fromkeys(paths))
+        objects = dict(zip(unique_paths, ordered_map(
+            batch_object,
+            [
+                safe_join(app.config['ROOT_PATH'], p.strip('/'))
+                if p.strip('/') else app.config['ROOT_PATH']
+                for p in unique_paths
+            ]
+        )))
+
+        files_list = []
+        not_found = []
+        for p in paths:
+            if objects[p] is None:
+                not_found.append(p)
+            else:
+                files_list.append(objects[p].get_metadata(fields_params))
+
+        response_obj = {
+            'itemsCount': len(files_list),
+            'filesList': files_list
+        }
+        if not_found:
+            response_obj['notFound'] = not_found
+        if fields_info:
+            response_obj['fieldsParams'] = fields_info
+
+        return Response(
+            response=json_dumps(response_obj),
+            status=200,
+            mimetype='application/json'
+        )
+    except Exception:
+        return json_http_response(dbg=request.args.get('dbg', False))
+
+
+@app.route('/search', methods=['GET'])
+def search_files():
+    """
+    Search files and directories in whole tree.
+
+    Query «q» consists of words separated by spaces: «word» (in name,
+    extension or type), «field:word» (field is name, extension or type;
+    «word*» means prefix) and range conditions «field>value» (field is
+    sizeBytes, modified or created; operators are <, <=, =, >=, >). Search
+    can be limited to directory by «path» parameter, «sf», «so», «fields»,
+    «start» and «limit» parameters work as in files list.
+    """
+    try:
+        search_query = request.args.get('q', '')
+        terms = []
+        ranges = []
+        for part in search_query.split():
+            range_match = re.fullmatch(
+                '(%s)(<=|>=|<|>|=)(.+)' % (
+                    '|'.join(search_index.range_fields)
+                ),
+                part
+            )
+            if range_match:
+                field, operator, value = range_match.groups()
+                try:
+                    if field == 'sizeBytes' or value.isdigit():
+                        value = int(value)
+                    else:
+                        value = int(datetime.fromisoformat(
+                            value
+                        ).timestamp())
+                except ValueError:
+                    return json_http_response(
+                        status=400,
+                        given_message="Incorrect value of «%s» in parameter "
+                        "'q' (should be integer number or date)" % (field),
+                        dbg=request.args.get('dbg', False)
+                    )
+                ranges.append((field, operator, value))
+                continue
+            field, _, value = part.rpartition(':')
+            if field and field not in search_index.text_fields:
+                return json_http_response(
+                    status=400,
+                    given_message="Unsupported field «%s» in parameter 'q' "
+                    "(should be one of: %s)" % (
+                        field,
+                        ', '.join(
+                            list(search_index.text_fields) +
+                            list(search_index.range_fields)
+                        )
+                    ),
+                    dbg=request.args.get('dbg', False)
+                )
+            # Слова разбиваются так же, как их разбивает FTS5
+            words = re.findall(r'[^\W_]+', value)
+            terms.extend(
+                (
+                    field or None,
+                    word,
+                    value.endswith('*') and i == len(words) - 1
+                )
+                for i, word in enumerate(words)
+            )
+
+        asked_file_path = request.args.get('path', '').strip('/')
+        search_path = None
+        if asked_file_path:
+            search_path = safe_join(app.config['ROOT_PATH'], asked_file_path)
+            if search_path is None or not os.path.isdir(search_path):
+                return json_http_response(
+                    status=404,
+                    given_message="Directory for search not found!",
+                    dbg=request.args.get('dbg', False)
+                )
+
+        sorting_query = request.args.get('sf', None)
+        sorting_params = [
+            k for k in (sorting_query or '').split(' ')
+            if k in search_index.text_fields or
+            k in search_index.range_fields
+        ] or ['name']
+        sorting_order = request.args.get('so', None)
+        sorting_reverse = bool(sorting_order) and \
+            sorting_order.lower() == 'd'
+
+        fields_params, fields_info = query_fields(
+            request.args,
+            FileSystemObject.fields
+        )
+
+        try:
+            start = max(int(request.args.get('start', 1)), 1)
+        except ValueError:
+            start = 1
+        limit = query_limit(request.args)
+
+        if not search_index.build():
+            # Индекс строится в фоне, запрос можно повторить позже
+            response = json_http_response(
+                status=503,
+                given_message="Search index is being built, try again "
+                "later!",
+                dbg=request.args.get('dbg', False)
+            )
+            response.headers['Retry-After'] = '30'
+            return response
+
+        def search_page(start):
+            """Get count of results and paths of page from «start»."""
+            return search_index.search(
+                terms,
+                ranges,
+                path=search_path,
+                order=sorting_params,
+                reverse=sorting_reverse,
+                offset=start - 1,
+                limit=limit
+            )
+
+        items_count, paths = search_page(start)
+        paginated_data = pagination_data(
+            items_count,
+            url_for('.search_files', _external=True),
+            query_params=request.args
+        )
+        if paginated_data['start'] != start:
+            items_count, paths = search_page(paginated_data['start'])
+
+        def found_object(path):
+            """Get object with computed fields or None if it was deleted."""
+            try:
+                return FileSystemObject(path, stat=os.stat(path)).prefetch(
+                    fields_params
+                )
+            except OSError:
+                search_index.discard(path)
+                return None
+
+        files_list = [
+            f.get_metadata(fields_params)
+            for f in ordered_map(found_object, paths) if f is not None
+        ]
+
+        response_obj = {
+            'paginationData': paginated_data,
+            'searchParams': {
+                'terms': [
+                    {
+                        'field': field or 'any',
+                        'word': word,
+                        'prefix': is_prefix
+                    }
+                    for field, word, is_prefix in terms
+                ],
+                'ranges': [
+                    {
+                        'field': field,
+                        'operator': operator,
+                        'value': value
+                    }
+                    for field, operator, value in ranges
+                ],
+                'sortedBy': sorting_params,
+                'sortingDirection': 'Desc' if sorting_reverse else 'Asc'
+            },
+            'filesList': files_list
+        }
+        if fields_info:
+            response_obj['fieldsParams'] = fields_info
+
+        return Response(
+            response=json_dumps(response_obj),
+            status=200,
+            mimetype='application/json'
+        )
+    except Exception:
+        return json_http_response(dbg=request.args.get('dbg', False))
+
+
 @app.route('/files', methods=['DELETE'])
 @app.route('/files/<path:asked_file_path>', methods=['DELETE'])
 def delete_file(asked_file_path=''):
@@ -389,6 +1026,13 @@ def delete_file(asked_file_path=''):
     try:
         file_real_path = os.path.join(app.config['ROOT_PATH'], asked_file_path)
 
+        if is_service_path(file_real_path):
+            return json_http_response(
+                status=403,
+                given_message="Service directories cannot be changed!",
+                dbg=request.args.get('dbg', False)
+            )
+
         if os.path.exists(file_real_path):
             is_directory = os.path.isdir(file_real_path)
             if is_directory:
@@ -405,10 +1049,17 @@ def delete_file(asked_file_path=''):
                     if recursive:
                         given_message += 'Directory delete recursively '
                         '(with all contents)!'
-                        shutil.rmtree(file_real_path)
+                        directory_sizes.remove(file_real_path)
+                        metadata_index.discard(file_real_path)
+                        render_cache.discard(file_real_path)
+                        search_index.discard(file_real_path)
                     else:
                         try:
-                            os.rmdir(file_real_path)
+                            directory_sizes.remove(
+                                file_real_path,
+                                recursive=False
+                            )
+                            search_index.discard(file_real_path)
                             given_message += 'Directory «%s» delete '
                             'successful!' % (
                                 asked_file_path.split('/')[-1:][0]
@@ -430,7 +1081,10 @@ def delete_file(asked_file_path=''):
             else:
                 try:
                     if os.path.exists(file_real_path):
-                        os.remove(file_real_path)
+                        directory_sizes.remove(file_real_path)
+                    metadata_index.discard(file_real_path)
+                    render_cache.discard(file_real_path)
+                    search_index.discard(file_real_path)
 
                     file_path, fileName = os.path.split(file_real_path)
 
@@ -440,7 +1094,7 @@ def delete_file(asked_file_path=''):
                     )
 
                     if os.path.exists(thumbnail_path):
-                        shutil.rmtree(thumbnail_path)
+                        directory_sizes.remove(thumbnail_path)
                     given_message = "File «%s» delete successful!" % (fileName)
                 except Exception:
                     return json_http_response(
@@ -454,7 +1108,7 @@ def delete_file(asked_file_path=''):
                     remove_empty = strtobool(remove_empty)
                 except Exception:
                     return Response(
-                        response=json.dumps(
+                        response=json_dumps(
                             {
                                 'info': "Your «removeEmpty» "
                                 "parameter is invalid (must "
@@ -473,7 +1127,8 @@ def delete_file(asked_file_path=''):
                 file_path, fileName = os.path.split(file_real_path)
 
                 if not os.listdir(file_path):
-                    shutil.rmtree(file_path)
+                    directory_sizes.remove(file_path)
+                    search_index.discard(file_path)
                     given_message += " Empty parent directory also removed."
 
             return json_http_response(status=200, given_message=given_message)
@@ -483,6 +1138,39 @@ def delete_file(asked_file_path=''):
         return json_http_response(dbg=request.args.get('dbg', False))
 
 
+def saved_file_metadata(file_path, file_hash, old_size, old_name):
+    """
+    Update derived data of saved (uploaded) file and get its metadata.
+
+    Parameters:
+    file_path (String) - Real path to saved file
+    file_hash (String) - SHA-512 hash of file, computed while saving
+    old_size (Integer number) - Size of overwritten file (0 if it is new)
+    old_name (String) - Original name of uploaded file
+    """
+    file_stat = os.stat(file_path)
+    directory_sizes.update(file_path, file_stat.st_size - old_size)
+    # Перезаписанный файл: рендеры и миниатюры прежнего содержимого
+    render_cache.discard(file_path)
+    thumbnail.invalidate(file_path)
+    duplicates = [
+        p for p in metadata_index.find(file_hash)
+        if p != file_path
+    ]
+    metadata_index.set(file_path, file_stat, hash=file_hash)
+
+    metadata = FileSystemObject(file_path, stat=file_stat).get_metadata()
+    metadata['oldName'] = old_name
+    search_index.add(file_path, file_stat, metadata['type'])
+    if metadata['type'].startswith('image/'):
+        thumbnail_queue.put(file_path)
+    if duplicates:
+        metadata['duplicates'] = [
+            FileSystemObject(p).link for p in duplicates
+        ]
+    return metadata
+
+
 @app.route('/files', methods=['POST'])
 @app.route('/files/<path:asked_file_path>', methods=['POST'])
 def post_file(asked_file_path=''):
@@ -498,12 +1186,19 @@ def post_file(asked_file_path=''):
 
         file_real_path = os.path.join(app.config['ROOT_PATH'], asked_file_path)
 
+        if is_service_path(file_real_path):
+            return json_http_response(
+                status=403,
+                given_message="Service directories cannot be changed!",
+                dbg=request.args.get('dbg', False)
+            )
+
         if uploads:
 
             defined_files_names = request.args.get('names', None)
 
             if not os.path.exists(file_real_path):
-                os.makedirs(file_real_path)
+                directory_sizes.makedirs(file_real_path)
 
             uploaded_files_list = []
             defined_files_names = defined_files_names.split(' ')\
@@ -523,12 +1218,16 @@ def post_file(asked_file_path=''):
                     )
 
                 file_path = os.path.join(file_real_path, new_full_file_name)
-                file.save(file_path)
-
-                metadata = FileSystemObject(file_path).get_metadata()
-                metadata['oldName'] = old_file_name
-
-                uploaded_files_list.append(metadata)
+                old_size = os.stat(file_path).st_size \
+                    if os.path.isfile(file_path) else 0
+                # Хэш считается во время записи, без повторного чтения
+                file_hash = save_with_hash(file.stream, file_path)
+                uploaded_files_list.append(saved_file_metadata(
+                    file_path,
+                    file_hash,
+                    old_size,
+                    old_file_name
+                ))
 
             parent_directory = url_for(
                 '.get_file',
@@ -554,7 +1253,7 @@ def post_file(asked_file_path=''):
                 response_obj['unprocessedParams'] = tmp_unprocessed_params
 
             return Response(
-                response=json.dumps(response_obj),
+                response=json_dumps(response_obj),
                 status=200,
                 mimetype='application/json'
             )
@@ -566,7 +1265,7 @@ def post_file(asked_file_path=''):
                     create_directory = strtobool(create_directory)
                 except Exception:
                     return Response(
-                        response=json.dumps(
+                        response=json_dumps(
                             {
                                 'info': "Your «createDirectory» parameter "
                                 "is invalid (must be boolean value)!",
@@ -582,9 +1281,10 @@ def post_file(asked_file_path=''):
 
             if create_directory:
                 if not os.path.exists(file_real_path):
-                    os.makedirs(file_real_path)
+                    directory_sizes.makedirs(file_real_path)
+                    search_index.add(file_real_path)
                 return Response(
-                    response=json.dumps(
+                    response=json_dumps(
                         {
                             'responseType': 'Success',
                             'status': 200,
@@ -596,7 +1296,7 @@ def post_file(asked_file_path=''):
                 )
             else:
                 return Response(
-                    response=json.dumps(
+                    response=json_dumps(
                         {
                             'info': "Maybe you want create directory? Send "
                             "«createDirectory» parameter with "
@@ -627,6 +1327,13 @@ def put_file(asked_file_path=''):
         file_real_path = os.path.join(app.config['ROOT_PATH'], asked_file_path)
         new_object_name = request.args.get('rename', None)
 
+        if is_service_path(file_real_path):
+            return json_http_response(
+                status=403,
+                given_message="Service directories cannot be changed!",
+                dbg=request.args.get('dbg', False)
+            )
+
         if new_object_name:
             if os.path.exists(file_real_path):
 
@@ -648,10 +1355,19 @@ def put_file(asked_file_path=''):
                     old_file_ext = old_file_name.split('.')[-1]
                     new_object_name += '.' + old_file_ext
 
-                os.rename(file_real_path, os.path.join(
-                    file_save_path,
-                    new_object_name
-                ))
+                new_real_path = os.path.join(file_save_path, new_object_name)
+                if is_service_path(new_real_path):
+                    return json_http_response(
+                        status=403,
+                        given_message="Service directories cannot be "
+                        "changed!",
+                        dbg=request.args.get('dbg', False)
+                    )
+                os.rename(file_real_path, new_real_path)
+                metadata_index.rename(file_real_path, new_real_path)
+                search_index.rename(file_real_path, new_real_path)
+                directory_sizes.discard(file_real_path)
+                render_cache.discard(file_real_path)
 
                 return json_http_response(
                     status=200,
@@ -673,3 +1389,264 @@ def put_file(asked_file_path=''):
             )
     except Exception:
         return json_http_response(dbg=request.args.get('dbg', False))
+
+
+def upload_status(session):
+    """
+    Get information about upload session for response.
+
+    Parameters:
+    session (Dictionary) - Upload session data
+    """
+    return {
+        'id': session['id'],
+        'link': url_for(
+            '.upload_chunk',
+            upload_id=session['id'],
+            _external=True
+        ),
+        'name': session['name'],
+        'sizeBytes': session['size'],
+        'receivedBytes': session['offset'],
+        'complete': session['offset'] == session['size']
+    }
+
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    """
+    Create session of resumable upload.
+
+    Method takes «path» (directory for file), «name» (original file name),
+    «size» (file size in bytes) and optional «newName» parameters. Then
+    chunks are sent by PUT and upload is finalized by POST to session link.
+    """
+    try:
+        asked_file_path = request.args.get('path', '').strip('/')
+        old_file_name = request.args.get('name', None)
+        new_file_name = request.args.get('newName', None)
+        try:
+            file_size = int(request.args.get('size', ''))
+        except ValueError:
+            file_size = -1
+
+        if not old_file_name or file_size < 0:
+            return json_http_response(
+                status=400,
+                given_message="You should send file «name» and «size» "
+                "(non-negative integer) parameters!",
+                dbg=request.args.get('dbg', False)
+            )
+
+        file_real_path = safe_join(app.config['ROOT_PATH'], asked_file_path) \
+            if asked_file_path else app.config['ROOT_PATH']
+        if file_real_path is None:
+            return json_http_response(
+                status=403,
+                given_message="Upload path is out of root directory!",
+                dbg=request.args.get('dbg', False)
+            )
+        if is_service_path(file_real_path):
+            return json_http_response(
+                status=403,
+                given_message="Service directories cannot be changed!",
+                dbg=request.args.get('dbg', False)
+            )
+        if os.path.exists(file_real_path) and \
+                not os.path.isdir(file_real_path):
+            return json_http_response(
+                status=400,
+                given_message="Upload path must be a directory!",
+                dbg=request.args.get('dbg', False)
+            )
+
+        old_file_ext = old_file_name.split(".")[-1]
+        new_full_file_name = secure_filename(
+            (new_file_name or uuid.uuid1().hex) + '.' + old_file_ext
+        )
+
+        upload_id = upload_sessions.create(
+            os.path.join(file_real_path, new_full_file_name),
+            old_file_name,
+            file_size
+        )
+        # Место под файл выделено заранее
+        directory_sizes.update(
+            upload_sessions.part_path(upload_id),
+            os.stat(upload_sessions.part_path(upload_id)).st_size
+        )
+
+        response_obj = upload_status(upload_sessions.get(upload_id))
+        response_obj.update({
+            'responseType': 'Success',
+            'status': 201,
+            'message': 'Upload session created!'
+        })
+        return Response(
+            response=json_dumps(response_obj),
+            status=201,
+            mimetype='application/json',
+            headers={'Location': response_obj['link']}
+        )
+    except Exception:
+        return json_http_response(dbg=request.args.get('dbg', False))
+
+
+@app.route('/uploads/<upload_id>', methods=['GET', 'PUT', 'POST', 'DELETE'])
+def upload_chunk(upload_id):
+    """
+    Handle upload session.
+
+    GET returns status of session (number of received bytes to resume
+    from), PUT writes chunk from request body at position from
+    «Content-Range» header (or at the end of received data), POST
+    finalizes upload and DELETE aborts it.
+    """
+    try:
+        session = upload_sessions.get(upload_id)
+        if session is None:
+            return json_http_response(
+                status=404,
+                given_message="Upload session not found or expired!",
+                dbg=request.args.get('dbg', False)
+            )
+
+        if request.method == 'GET':
+            response_obj = upload_status(session)
+        elif request.method == 'PUT':
+            start = session['offset']
+            length = request.content_length or 0
+            content_range = request.headers.get('Content-Range')
+            if content_range:
+                parsed_range = parse_content_range_header(content_range)
+                if parsed_range is None or \
+                        parsed_range.units != 'bytes' or \
+                        parsed_range.length not in (None, session['size']):
+                    return json_http_response(
+                        status=400,
+                        given_message="Invalid «Content-Range» header!",
+                        dbg=request.args.get('dbg', False)
+                    )
+                if parsed_range.start is None:
+                    # «bytes */N» не содержит данных части
+                    return json_http_response(
+                        status=400,
+                        given_message="«Content-Range» header must contain "
+                        "byte positions of chunk!",
+                        dbg=request.args.get('dbg', False)
+                    )
+                start = parsed_range.start
+                length = parsed_range.stop - parsed_range.start
+                if request.content_length is not None and \
+                        request.content_length != length:
+                    return json_http_response(
+                        status=400,
+                        given_message="Length of chunk doesn`t match "
+                        "«Content-Range» header!",
+                        dbg=request.args.get('dbg', False)
+                    )
+
+            try:
+                upload_sessions.write(upload_id, start, request.stream, length)
+            except ValueError as e:
+                # Части принимаются строго по порядку
+                response = json_http_response(
+                    status=409,
+                    given_message="Chunk must start at byte %s!" % (
+                        e.args[0]
+                    ),
+                    dbg=request.args.get('dbg', False)
+                )
+                # Диапазон принятых байтов (пустой диапазон не передается)
+                if e.args[0] > 0:
+                    response.headers['Range'] = 'bytes=0-%s' % (
+                        e.args[0] - 1
+                    )
+                return response
+            except OverflowError:
+                return json_http_response(
+                    status=400,
+                    given_message="Chunk is out of declared file size!",
+                    dbg=request.args.get('dbg', False)
+                )
+            response_obj = upload_status(upload_sessions.get(upload_id))
+        elif request.method == 'POST':
+            if session['offset'] != session['size']:
+                return json_http_response(
+                    status=409,
+                    given_message="Upload is not complete: received %s of "
+                    "%s bytes!" % (session['offset'], session['size']),
+                    dbg=request.args.get('dbg', False)
+                )
+
+            file_path = session['path']
+            if not os.path.exists(os.path.dirname(file_path)):
+                directory_sizes.makedirs(os.path.dirname(file_path))
+            old_size = os.stat(file_path).st_size \
+                if os.path.isfile(file_path) else 0
+            part_size = os.stat(
+                upload_sessions.part_path(upload_id)
+            ).st_size
+            file_path, file_hash = upload_sessions.finalize(upload_id)
+            directory_sizes.update(
+                upload_sessions.part_path(upload_id),
+                -part_size
+            )
+            metadata = saved_file_metadata(
+                file_path,
+                file_hash,
+                old_size,
+                session['name']
+            )
+
+            asked_file_path = os.path.relpath(
+                os.path.dirname(file_path),
+                app.config['ROOT_PATH']
+            )
+            response_obj = {
+                'uploadedIn': url_for(
+                    '.get_file',
+                    asked_file_path=asked_file_path
+                    if asked_file_path != '.' else None,
+                    _external=True
+                ),
+                'uploadedFiles': [metadata],
+                'responseType': 'Success',
+                'status': 200,
+                'message': 'Files upload successful!'
+            }
+            return Response(
+                response=json_dumps(response_obj),
+                status=200,
+                mimetype='application/json'
+            )
+        else:
+            try:
+                part_size = os.stat(
+                    upload_sessions.part_path(upload_id)
+                ).st_size
+            except OSError:
+                part_size = 0
+            upload_sessions.discard(upload_id)
+            directory_sizes.update(
+                upload_sessions.part_path(upload_id),
+                -part_size
+            )
+            return json_http_response(
+                status=200,
+                given_message="Upload session aborted!",
+                dbg=request.args.get('dbg', False)
+            )
+
+        response_obj.update({
+            'responseType': 'Success',
+            'status': 200,
+            'message': 'OK!'
+        })
+        return Response(
+            response=json_dumps(response_obj),
+            status=200,
+            mimetype='application/json'
+        )
+    except Exception:
+        return json_http_response(dbg=request.args.get('dbg', False))
@@ -1,72 +1,1911 @@
 """Classes for API."""
 # -*- coding: utf-8 -*-
 import os
+import re
+import fnmatch
+import ctypes
+import ctypes.util
+import fcntl
 import magic
-import subprocess
+import struct
+import sqlite3
 import hashlib
-from datetime import datetime
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict, namedtuple
+from itertools import islice
+from operator import attrgetter, itemgetter
+from datetime import datetime, timedelta
+from stat import S_ISDIR
 from flask import url_for
+from flask_thumbnails import Thumbnail
+from flask_thumbnails.storage_backends import FilesystemStorageBackend
+from flask_thumbnails.utils import aspect_to_string, generate_filename, \
+    parse_size
 from app import app
+from app.utils import IMAGE_FORMATS, file_lock, open_image
 
 
-class FileSystemObject:
-    """Class describing files and directories on filesystem as objects."""
+# Значения stat, по которым проверяются записи индекса метаданных
+IndexedStat = namedtuple('IndexedStat', ('st_ino', 'st_size', 'st_mtime_ns'))
+
+
+class AtomicFilesystemStorageBackend(FilesystemStorageBackend):
+    """
+    Thumbnails storage, which writes files atomically.
+
+    File is written to temporary file and renamed, so other processes never
+    see partially written thumbnail.
+    """
+
+    def save(self, filepath, data):
+        """Save data to file atomically."""
+        temp_path = '%s.%s.tmp' % (filepath, uuid.uuid4().hex)
+        try:
+            super().save(temp_path, data)
+            os.replace(temp_path, filepath)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+
+class ReducedThumbnail(Thumbnail):
+    """
+    Thumbnails generator, which decodes originals at reduced resolution.
+
+    Memory and CPU usage depend on thumbnail size, not on original size
+    (see «open_image»). Thumbnail files names are the same as in parent,
+    but explicitly set format is appended as extension after extension of
+    original («scan.jpg_200x200_90.webp»), so every format has its own
+    file and originals differing only by extension don't share thumbnails.
+    """
+
+    def get_raw_data(self, image, **options):
+        """Get encoded thumbnail (without alpha channel for JPEG)."""
+        if self._get_format(image, **options) == 'JPEG' and \
+                image.mode not in ('RGB', 'L', 'CMYK'):
+            image = image.convert('RGB')
+        return super().get_raw_data(image, **options)
+
+    # Параметры в имени миниатюры: _<размер>[_<обрезка>]_<качество>
+    options_pattern = r'_\d+(?:x\d+)?(?:_[a-z]+)?_\d+'
+
+    def invalidate(self, path):
+        """
+        Delete thumbnails of changed or deleted original (real path).
+
+        Thumbnails created after last change of original are kept.
+        """
+        relpath = os.path.relpath(path, self.root_directory)
+        if relpath.startswith(os.pardir):
+            return
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stat = None
+        if stat is None:
+            # Удаленная директория: миниатюры всего поддерева
+            shutil.rmtree(
+                os.path.join(self.thumbnail_directory, relpath),
+                ignore_errors=True
+            )
+        elif S_ISDIR(stat.st_mode):
+            return
+        directory, filename = os.path.split(
+            os.path.join(self.thumbnail_directory, relpath)
+        )
+        name, ext = os.path.splitext(filename)
+        # Имя миниатюры: <имя>_<размер>[_<обрезка>]_<качество><расширение
+        # оригинала> или <имя файла>_<размер>[_<обрезка>]_<качество>
+        # <расширение формата> (см. get_thumbnail). Шаблон точный, чтобы
+        # миниатюры «a_1.jpg» не удалялись вместе с миниатюрами «a.jpg»
+        options = self.options_pattern
+        pattern = re.compile(r'(?:%s%s%s|%s%s\.(?:%s))\Z' % (
+            re.escape(name),
+            options,
+            re.escape(ext),
+            re.escape(filename),
+            options,
+            '|'.join(sorted(
+                re.escape(extension)
+                for mimetype, extension in IMAGE_FORMATS.values()
+            ))
+        ))
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if not pattern.match(entry.name):
+                        continue
+                    try:
+                        if stat is None or entry.stat().st_mtime_ns < \
+                                stat.st_mtime_ns:
+                            os.remove(entry.path)
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+
+    def reset(self):
+        """
+        Delete thumbnails older than their originals in whole tree.
+
+        Used when changes of originals could be missed. Thumbnail is
+        deleted if its original (with the same extension or with format
+        extension appended) is deleted or changed after thumbnail creation.
+        """
+        pattern = re.compile(
+            r'(.+)%s(\.[^.]*)?\Z' % (self.options_pattern)
+        )
+        for directory, _, filenames in os.walk(self.thumbnail_directory):
+            originals = os.path.join(
+                self.root_directory,
+                os.path.relpath(directory, self.thumbnail_directory)
+            )
+            for filename in filenames:
+                match = pattern.match(filename)
+                if match is None:
+                    continue
+                name, ext = match.group(1), match.group(2) or ''
+                path = os.path.join(directory, filename)
+                try:
+                    mtime_ns = os.stat(path).st_mtime_ns
+                except OSError:
+                    continue
+                stats = []
+                for original in {name + ext, name}:
+                    try:
+                        stats.append(
+                            os.stat(os.path.join(originals, original))
+                        )
+                    except OSError:
+                        pass
+                if not stats or any(
+                    mtime_ns < stat.st_mtime_ns for stat in stats
+                ):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+
+    def thumbnail_filename(self, original_filename, size, **options):
+        """
+        Get file name of thumbnail.
+
+        Parameters:
+        original_filename (String) - File name of original
+        size (String) - Thumbnail size (INT or INTxINT)
+        options (Dictionary) - crop, background, quality and format
+        """
+        thumbnail_filename = original_filename
+        if options.get('format') in IMAGE_FORMATS:
+            # Расширение оригинала сохраняется в имени перед расширением
+            # формата: «scan.jpg» и «scan.png» не делят одну миниатюру
+            thumbnail_filename = '%s.%s' % (
+                original_filename,
+                IMAGE_FORMATS[options['format']][1]
+            )
+        return generate_filename(
+            thumbnail_filename,
+            aspect_to_string(size),
+            options.get('crop', 'fit'),
+            options.get('background'),
+            options.get('quality', 90)
+        )
+
+    def get_thumbnail(self, original, size, **options):
+        """
+        Get thumbnail URL (create thumbnail if it doesn't exist).
+
+        Parameters:
+        original (String) - Path to original relative to media root
+        size (String) - Thumbnail size (INT or INTxINT)
+        options (Dictionary) - crop, background, quality and format
+        """
+        storage = self.get_storage_backend()
+        crop = options.get('crop', 'fit')
+        background = options.get('background')
+        thumbnail_size = parse_size(size)
+
+        original_path, original_filename = os.path.split(original)
+        thumbnail_filename = self.thumbnail_filename(
+            original_filename,
+            size,
+            **options
+        )
+
+        original_filepath = os.path.join(
+            self.root_directory,
+            original_path,
+            original_filename
+        )
+        thumbnail_filepath = os.path.join(
+            self.thumbnail_directory,
+            original_path,
+            thumbnail_filename
+        )
+        thumbnail_url = os.path.join(
+            self.thumbnail_url,
+            original_path,
+            thumbnail_filename
+        )
+
+        if storage.exists(thumbnail_filepath):
+            return thumbnail_url
+
+        # Only one process renders thumbnail, others wait and reuse it
+        with file_lock(thumbnail_filepath):
+            if storage.exists(thumbnail_filepath):
+                return thumbnail_url
 
-    def __init__(self, path):
+            try:
+                image = open_image(
+                    original_filepath,
+                    thumbnail_size,
+                    fit=crop == 'fit'
+                )
+            except (IOError, OSError):
+                self.app.logger.warning(
+                    'Thumbnail not load image: %s',
+                    original_filepath
+                )
+                return thumbnail_url
+
+            # get original image format
+            options['format'] = options.get('format', image.format)
+
+            image = self._create_thumbnail(
+                image,
+                thumbnail_size,
+                crop,
+                background=background
+            )
+
+            raw_data = self.get_raw_data(image, **options)
+            storage.save(thumbnail_filepath, raw_data)
+
+        return thumbnail_url
+
+
+class SQLiteStorage:
+    """
+    Base class of storages in SQLite database shared by all processes.
+
+    Every thread gets its own connection, database is created with tables
+    described in «schema» on first connection.
+    """
+
+    schema = ()
+
+    def __init__(self, db_path):
         """Class description."""
-        self.path = path
-        self.type = 'directory' if os.path.isdir(self.path) \
-            else magic.from_file(self.path, mime=True)
-        self.name = self.path.rsplit('/', maxsplit=1)[-1]
-        self.link = url_for(
-            '.get_file',
-            asked_file_path=os.path.relpath(
-                self.path,
-                app.config['ROOT_PATH']
-            ),
-            _external=True
+        self.db_path = db_path
+        self._local = threading.local()
+
+    def __repr__(self):
+        """Class representation string."""
+        return "%s «%s»" % (self.__class__.__name__, self.db_path)
+
+    def connection(self):
+        """Get SQLite connection for current thread (create if needed)."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            for statement in self.schema:
+                conn.execute(statement)
+            self._local.conn = conn
+        return conn
+
+
+class MetadataIndex(SQLiteStorage):
+    """
+    Persistent index of files metadata in SQLite database.
+
+    Records are keyed by path relative to root directory and are valid only
+    while inode, size and modification time of file are the same as stored.
+    """
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS metadata ('
+        'path TEXT PRIMARY KEY, ino INTEGER, size INTEGER, '
+        'mtime_ns INTEGER, type TEXT, hash TEXT)',
+        'CREATE INDEX IF NOT EXISTS metadata_hash ON metadata (hash)'
+    )
+
+    def key(self, path):
+        """Get index key (path relative to root directory)."""
+        return os.path.relpath(path, app.config['ROOT_PATH'])
+
+    def get(self, path, stat):
+        """
+        Get indexed metadata of file if it didn't change.
+
+        Parameters:
+        path (String) - Real path to file
+        stat (os.stat_result) - Current stat of file
+        """
+        try:
+            row = self.connection().execute(
+                'SELECT ino, size, mtime_ns, type, hash FROM metadata '
+                'WHERE path = ?',
+                (self.key(path),)
+            ).fetchone()
+        except (sqlite3.Error, OSError):
+            return None
+        if row is None or \
+                row[:3] != (stat.st_ino, stat.st_size, stat.st_mtime_ns):
+            return None
+        return {'type': row[3], 'hash': row[4]}
+
+    def set(self, path, stat, type=None, hash=None):
+        """
+        Save metadata of file in index.
+
+        Parameters:
+        path (String) - Real path to file
+        stat (os.stat_result) - Stat of file metadata computed for
+        type (String) - MIME type of file
+        hash (String) - SHA-512 hash of file
+        """
+        try:
+            with self.connection() as conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO metadata '
+                    '(path, ino, size, mtime_ns, type, hash) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (
+                        self.key(path), stat.st_ino, stat.st_size,
+                        stat.st_mtime_ns, type, hash
+                    )
+                )
+        except (sqlite3.Error, OSError):
+            pass
+
+    def find(self, hash, path=None):
+        """
+        Find files with given hash, which didn't change since indexing.
+
+        Parameters:
+        hash (String) - SHA-512 hash of file
+        path (String) - Real path to directory to search in (optional)
+        """
+        try:
+            rows = self.connection().execute(
+                'SELECT path, ino, size, mtime_ns FROM metadata '
+                'WHERE hash = ? ORDER BY path',
+                (hash,)
+            ).fetchall()
+        except (sqlite3.Error, OSError):
+            return []
+        prefix = None
+        if path is not None:
+            prefix = self.key(path)
+            prefix = '' if prefix == '.' else prefix + '/'
+        found = []
+        for row in rows:
+            if prefix and not row[0].startswith(prefix):
+                continue
+            real_path = os.path.join(app.config['ROOT_PATH'], row[0])
+            try:
+                stat = os.stat(real_path)
+            except OSError:
+                continue
+            if row[1:] == (stat.st_ino, stat.st_size, stat.st_mtime_ns):
+                found.append(real_path)
+        return found
+
+    def discard(self, path):
+        """Remove records of file or directory (with all contents)."""
+        key = self.key(path)
+        try:
+            with self.connection() as conn:
+                conn.execute(
+                    'DELETE FROM metadata WHERE path = ? OR '
+                    'substr(path, 1, ?) = ?',
+                    (key, len(key) + 1, key + '/')
+                )
+        except (sqlite3.Error, OSError):
+            pass
+
+    def invalidate(self, path):
+        """Remove records of file if it was changed or deleted."""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.discard(path)
+            return
+        if S_ISDIR(stat.st_mode):
+            return
+        try:
+            with self.connection() as conn:
+                conn.execute(
+                    'DELETE FROM metadata WHERE path = ? AND '
+                    '(ino != ? OR size != ? OR mtime_ns != ?)',
+                    (
+                        self.key(path), stat.st_ino, stat.st_size,
+                        stat.st_mtime_ns
+                    )
+                )
+        except (sqlite3.Error, OSError):
+            pass
+
+    def rename(self, old_path, new_path):
+        """Move records of renamed file or directory to new path."""
+        old_key = self.key(old_path)
+        new_key = self.key(new_path)
+        try:
+            with self.connection() as conn:
+                conn.execute(
+                    'DELETE FROM metadata WHERE path = ? OR '
+                    'substr(path, 1, ?) = ?',
+                    (new_key, len(new_key) + 1, new_key + '/')
+                )
+                conn.execute(
+                    'UPDATE metadata SET path = ? || substr(path, ?) '
+                    'WHERE path = ? OR substr(path, 1, ?) = ?',
+                    (
+                        new_key, len(old_key) + 1,
+                        old_key, len(old_key) + 1, old_key + '/'
+                    )
+                )
+        except (sqlite3.Error, OSError):
+            pass
+
+
+metadata_index = MetadataIndex(app.config['METADATA_INDEX_FILE'])
+
+
+class SearchIndex(SQLiteStorage):
+    """
+    Search index of all objects in root directory tree in SQLite database.
+
+    Names, extensions and MIME types are tokenized by FTS5 (words and
+    prefixes search), sizes and modification and creation times are
+    indexed for range queries and sorting. Index is built by crawling tree
+    once in background thread and then is updated by API handlers and file
+    system watcher.
+    """
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS files ('
+        'id INTEGER PRIMARY KEY, path TEXT UNIQUE, name TEXT, '
+        'extension TEXT, type TEXT, size INTEGER, mtime INTEGER, '
+        'ctime INTEGER)',
+        'CREATE INDEX IF NOT EXISTS files_name ON files (name, path)',
+        'CREATE INDEX IF NOT EXISTS files_size ON files (size)',
+        'CREATE INDEX IF NOT EXISTS files_mtime ON files (mtime)',
+        'CREATE INDEX IF NOT EXISTS files_ctime ON files (ctime)',
+        'CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5('
+        'name, extension, type, content=files, content_rowid=id)',
+        'CREATE TRIGGER IF NOT EXISTS files_insert AFTER INSERT ON files '
+        'BEGIN INSERT INTO files_fts (rowid, name, extension, type) '
+        'VALUES (new.id, new.name, new.extension, new.type); END',
+        'CREATE TRIGGER IF NOT EXISTS files_delete AFTER DELETE ON files '
+        'BEGIN INSERT INTO files_fts (files_fts, rowid, name, extension, '
+        'type) VALUES (\'delete\', old.id, old.name, old.extension, '
+        'old.type); END',
+        'CREATE TRIGGER IF NOT EXISTS files_update AFTER UPDATE ON files '
+        'BEGIN INSERT INTO files_fts (files_fts, rowid, name, extension, '
+        'type) VALUES (\'delete\', old.id, old.name, old.extension, '
+        'old.type); INSERT INTO files_fts (rowid, name, extension, type) '
+        'VALUES (new.id, new.name, new.extension, new.type); END'
+    )
+    # Версия содержимого индекса: при ее изменении индекс строится заново
+    version = 2
+    # Поля запроса и соответствующие им столбцы
+    text_fields = {'name': 'name', 'extension': 'extension', 'type': 'type'}
+    range_fields = {'sizeBytes': 'size', 'modified': 'mtime',
+                    'created': 'ctime'}
+
+    def __init__(self, db_path, ignored=()):
+        """
+        Class description.
+
+        Parameters:
+        db_path (String) - Path to SQLite database
+        ignored (List of strings) - Not indexed directories
+        """
+        super().__init__(db_path)
+        self.ignored = [os.path.normpath(p) for p in ignored]
+        self._builder = None
+        self._lock = threading.Lock()
+
+    def key(self, path):
+        """Get index key (path relative to root directory)."""
+        return os.path.relpath(path, app.config['ROOT_PATH'])
+
+    def ignores(self, path):
+        """Check if path is out of index (root, service or outer path)."""
+        path = os.path.normpath(path)
+        return not path.startswith(
+            os.path.join(os.path.normpath(app.config['ROOT_PATH']), '')
+        ) or any(
+            path == p or path.startswith(p + os.sep) for p in self.ignored
+        )
+
+    def record(self, path, stat, type=None):
+        """Get row of index for object."""
+        name = os.path.basename(path)
+        if S_ISDIR(stat.st_mode):
+            extension = ''
+            type = 'directory'
+            size = None
+        else:
+            extension = os.path.splitext(name)[1][1:].lower()
+            if type is None:
+                # Тип определяется так же, как в листингах (по содержимому,
+                # с сохранением в индекс метаданных)
+                try:
+                    type = FileSystemObject(path, stat=stat).type
+                except (OSError, magic.MagicException):
+                    type = 'application/octet-stream'
+            size = stat.st_size
+        return (
+            self.key(path), name, extension, type, size,
+            int(stat.st_mtime), int(stat.st_ctime)
+        )
+
+    def write(self, conn, records):
+        """Insert or update rows of index."""
+        conn.executemany(
+            'INSERT INTO files '
+            '(path, name, extension, type, size, mtime, ctime) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (path) DO UPDATE SET '
+            'name = excluded.name, extension = excluded.extension, '
+            'type = excluded.type, size = excluded.size, '
+            'mtime = excluded.mtime, ctime = excluded.ctime',
+            records
         )
-        self.sizeBytes = int(
-            subprocess.check_output(
-                "du -sb %s | cut -f1" % (self.path),
-                shell=True
+
+    def crawl(self, path):
+        """Get rows of index for all objects in directory tree."""
+        stack = [path]
+        while stack:
+            try:
+                with os.scandir(stack.pop()) as entries:
+                    for entry in entries:
+                        if self.ignores(entry.path):
+                            continue
+                        try:
+                            stat = entry.stat(follow_symlinks=False)
+                        except OSError:
+                            continue
+                        yield self.record(entry.path, stat)
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+            except OSError:
+                pass
+
+    def is_built(self):
+        """Check if whole tree was crawled into index."""
+        return self.connection().execute(
+            'PRAGMA user_version'
+        ).fetchone()[0] == self.version
+
+    def build(self):
+        """
+        Check if index is built, else start building it in background.
+
+        Returns True if index is ready for search.
+        """
+        if self.is_built():
+            return True
+        with self._lock:
+            if self._builder is None or not self._builder.is_alive():
+                self._builder = threading.Thread(
+                    target=self.crawl_tree,
+                    name='search-index',
+                    daemon=True
+                )
+                self._builder.start()
+        return False
+
+    def reset(self):
+        """Mark index as not built and start building it again."""
+        try:
+            self.connection().execute('PRAGMA user_version = 0')
+        except sqlite3.Error:
+            app.logger.exception('Search index reset failed')
+            return
+        self.build()
+
+    def crawl_tree(self, batch_size=1000):
+        """
+        Crawl whole tree into index (once for all processes).
+
+        Records are committed by batches, index is marked as built only
+        after whole tree is crawled, so interrupted build starts again.
+
+        Parameters:
+        batch_size (Integer number) - Count of records in one transaction
+        """
+        conn = self.connection()
+        with open(self.db_path + '.build', 'a') as lock:
+            # Индекс уже строит другой процесс
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return
+            try:
+                if self.is_built():
+                    return
+                with conn:
+                    conn.execute('DELETE FROM files')
+                records = self.crawl(app.config['ROOT_PATH'])
+                batch = list(islice(records, batch_size))
+                while batch:
+                    with conn:
+                        self.write(conn, batch)
+                    batch = list(islice(records, batch_size))
+                conn.execute('PRAGMA user_version = %d' % (self.version))
+            except sqlite3.Error:
+                app.logger.exception('Search index build failed')
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def add(self, path, stat=None, type=None):
+        """
+        Add object and its not indexed parent directories to index.
+
+        Parameters:
+        path (String) - Real path to object
+        stat (os.stat_result) - Stat of object
+        type (String) - MIME type of file (detected by content if not
+        given)
+        """
+        if self.ignores(path):
+            return
+        try:
+            records = [self.record(path, stat or os.stat(path), type)]
+            conn = self.connection()
+            head = os.path.dirname(os.path.normpath(path))
+            # Подъем заканчивается на корне: он и все, что выше, не
+            # индексируются
+            while not self.ignores(head) and conn.execute(
+                'SELECT 1 FROM files WHERE path = ?',
+                (self.key(head),)
+            ).fetchone() is None:
+                records.append(self.record(head, os.stat(head)))
+                head = os.path.dirname(head)
+            with conn:
+                self.write(conn, records)
+        except (sqlite3.Error, OSError):
+            pass
+
+    def discard(self, path):
+        """Remove records of file or directory (with all contents)."""
+        key = self.key(path)
+        try:
+            with self.connection() as conn:
+                conn.execute(
+                    'DELETE FROM files WHERE path = ? OR '
+                    'substr(path, 1, ?) = ?',
+                    (key, len(key) + 1, key + '/')
+                )
+        except (sqlite3.Error, OSError):
+            pass
+
+    def rename(self, old_path, new_path):
+        """Move records of renamed file or directory to new path."""
+        old_key = self.key(old_path)
+        new_key = self.key(new_path)
+        try:
+            record = self.record(new_path, os.stat(new_path))
+            with self.connection() as conn:
+                conn.execute(
+                    'DELETE FROM files WHERE path = ? OR '
+                    'substr(path, 1, ?) = ?',
+                    (new_key, len(new_key) + 1, new_key + '/')
+                )
+                conn.execute(
+                    'UPDATE files SET path = ? || substr(path, ?) '
+                    'WHERE path = ? OR substr(path, 1, ?) = ?',
+                    (
+                        new_key, len(old_key) + 1,
+                        old_key, len(old_key) + 1, old_key + '/'
+                    )
+                )
+                self.write(conn, [record])
+        except (sqlite3.Error, OSError):
+            pass
+
+    def invalidate(self, path):
+        """Update records of changed object (new directory is crawled)."""
+        if self.ignores(path):
+            return
+        try:
+            stat = os.stat(path, follow_symlinks=False)
+        except OSError:
+            self.discard(path)
+            return
+        conn = self.connection()
+        is_new = conn.execute(
+            'SELECT 1 FROM files WHERE path = ?',
+            (self.key(path),)
+        ).fetchone() is None
+        self.add(path, stat)
+        if is_new and S_ISDIR(stat.st_mode):
+            with conn:
+                self.write(conn, self.crawl(path))
+
+    def search(
+            self, terms=(), ranges=(), path=None, order=('name',),
+            reverse=False, offset=0, limit=10
+    ):
+        """
+        Find objects and return their count and real paths of one page.
+
+        Parameters:
+        terms (List of tuples) - Words as (field or None, word, is_prefix)
+        ranges (List of tuples) - Conditions as (field, operator, value)
+        path (String) - Real path to directory to search in
+        order (List of strings) - Sorting fields
+        reverse (Boolean) - Descending sorting
+        offset (Integer number) - Count of skipped results
+        limit (Integer number) - Count of returned results
+        """
+        conditions = []
+        params = []
+        if terms:
+            # Слова экранируются, синтаксис FTS5 из запроса не передается
+            conditions.append(
+                'id IN (SELECT rowid FROM files_fts WHERE files_fts MATCH ?)'
+            )
+            params.append(' AND '.join(
+                '%s"%s"%s' % (
+                    '%s : ' % (self.text_fields[field]) if field else '',
+                    word.replace('"', '""'),
+                    '*' if is_prefix else ''
+                )
+                for field, word, is_prefix in terms
+            ))
+        for field, operator, value in ranges:
+            conditions.append('%s %s ?' % (
+                self.range_fields[field],
+                operator
+            ))
+            params.append(value)
+        if path is not None and not self.ignores(path):
+            key = self.key(path)
+            conditions.append('substr(path, 1, ?) = ?')
+            params.extend((len(key) + 1, key + '/'))
+        where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+        columns = dict(self.text_fields, **self.range_fields)
+        # Путь дополняет ключ сортировки, чтобы порядок страниц был полным
+        order_by = ', '.join([
+            '%s%s' % (columns[f], ' DESC' if reverse else '')
+            for f in order if f in columns
+        ] + ['path'])
+
+        conn = self.connection()
+        count = conn.execute(
+            'SELECT count(*) FROM files' + where,
+            params
+        ).fetchone()[0]
+        rows = conn.execute(
+            'SELECT path FROM files%s ORDER BY %s LIMIT ? OFFSET ?' % (
+                where,
+                order_by
+            ),
+            params + [limit, offset]
+        ).fetchall()
+        return count, [
+            os.path.join(app.config['ROOT_PATH'], row[0]) for row in rows
+        ]
+
+
+class DirectorySizeAggregator:
+    """
+    In-process cache of directories total sizes.
+
+    Totals are counted like «du -sb» does (apparent sizes of all files and
+    directories in tree) and are computed for whole subtree at once, so
+    nested directories are cached too. API handlers report changes of tree
+    and cached totals are updated up the parent chain.
+    """
+
+    def __init__(self, ttl=None):
+        """Class description."""
+        self.ttl = ttl
+        self._totals = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        """Class representation string."""
+        return "Directory size aggregator (%d cached)" % (len(self._totals))
+
+    def get(self, path):
+        """Get total size of directory in bytes."""
+        path = os.path.normpath(path)
+        with self._lock:
+            cached = self._totals.get(path)
+        if cached is not None and (
+            self.ttl is None or time.monotonic() - cached[1] < self.ttl
+        ):
+            return cached[0]
+        return self.compute(path)
+
+    def compute(self, path):
+        """
+        Walk directory tree and cache totals of all its directories.
+
+        Actual cached totals of subdirectories are reused.
+        """
+        total = os.stat(path, follow_symlinks=False).st_size
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        total += self.get(entry.path)
+                    else:
+                        total += entry.stat(follow_symlinks=False).st_size
+        except (FileNotFoundError, PermissionError):
+            pass
+        with self._lock:
+            self._totals[path] = (total, time.monotonic())
+        return total
+
+    def update(self, path, delta):
+        """
+        Add size delta of changed object to totals of its parents.
+
+        Parameters:
+        path (String) - Real path to created, changed or deleted object
+        delta (Integer number) - Change of object size in bytes
+        """
+        root = os.path.normpath(app.config['ROOT_PATH'])
+        head = os.path.normpath(path)
+        with self._lock:
+            while head != root and head != os.path.dirname(head):
+                head = os.path.dirname(head)
+                cached = self._totals.get(head)
+                if cached is not None:
+                    self._totals[head] = (cached[0] + delta, cached[1])
+
+    def discard(self, path):
+        """Remove cached totals of directory and all its subdirectories."""
+        path = os.path.normpath(path)
+        prefix = path + os.sep
+        with self._lock:
+            for key in [
+                k for k in self._totals
+                if k == path or k.startswith(prefix)
+            ]:
+                del self._totals[key]
+
+    def invalidate(self, path):
+        """Remove cached totals of changed object parents and subtree."""
+        self.discard(path)
+        root = os.path.normpath(app.config['ROOT_PATH'])
+        head = os.path.normpath(path)
+        with self._lock:
+            while head != root and head != os.path.dirname(head):
+                head = os.path.dirname(head)
+                self._totals.pop(head, None)
+
+    def remove(self, path, recursive=True):
+        """
+        Delete file or directory and subtract its size from totals.
+
+        Parameters:
+        path (String) - Real path to file or directory
+        recursive (Boolean) - Delete directory with all its contents
+        """
+        if os.path.isdir(path) and not os.path.islink(path):
+            if recursive:
+                size = self.get(path)
+                shutil.rmtree(path)
+            else:
+                size = os.stat(path).st_size
+                os.rmdir(path)
+        else:
+            size = os.stat(path, follow_symlinks=False).st_size
+            os.remove(path)
+        self.update(path, -size)
+        self.discard(path)
+
+    def makedirs(self, path):
+        """Create directory tree and add new directories to totals."""
+        top = None
+        head = os.path.normpath(path)
+        while not os.path.exists(head):
+            top = head
+            head = os.path.dirname(head)
+        os.makedirs(path, exist_ok=True)
+        if top is not None:
+            self.update(top, self.get(top))
+
+
+directory_sizes = DirectorySizeAggregator(app.config['DIRECTORY_SIZE_TTL'])
+
+
+class DirectoryListingIndex:
+    """
+    In-process cache of directories entries names in sorted order.
+
+    Lists are validated by modification time of directory (it changes when
+    entries are created, deleted or renamed) and the least recently used
+    ones are dropped when cache is full.
+    """
+
+    def __init__(self, max_size=128):
+        """Class description."""
+        self.max_size = max_size
+        self._listings = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        """Class representation string."""
+        return "Directory listing index (%d cached)" % (len(self._listings))
+
+    def names(self, path):
+        """Get sorted list of names of directory entries."""
+        path = os.path.normpath(path)
+        mtime_ns = os.stat(path).st_mtime_ns
+        with self._lock:
+            cached = self._listings.get(path)
+            if cached is not None and cached[0] == mtime_ns:
+                self._listings.move_to_end(path)
+                return cached[1]
+        names = sorted(os.listdir(path))
+        with self._lock:
+            self._listings[path] = (mtime_ns, names)
+            self._listings.move_to_end(path)
+            while len(self._listings) > self.max_size:
+                self._listings.popitem(last=False)
+        return names
+
+
+listing_index = DirectoryListingIndex(app.config['LISTING_INDEX_SIZE'])
+
+
+class ThumbnailQueue(SQLiteStorage):
+    """
+    Queue of thumbnails pre-generation jobs in SQLite database.
+
+    Jobs are shared by all processes and are processed by worker threads
+    of every process which started the queue. Job of dead worker is
+    returned to queue after «claim_timeout» seconds. Every preset is
+    generated in default format and in each of «formats», so requests
+    with negotiated format get ready thumbnails too.
+    """
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS jobs ('
+        'id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT, size TEXT, '
+        'crop TEXT, attempts INTEGER DEFAULT 0, claimed_at REAL)',
+    )
+
+    def __init__(
+            self, db_path, generator, presets=(), formats=(), workers=2,
+            claim_timeout=600, max_attempts=3
+    ):
+        """
+        Class description.
+
+        Parameters:
+        db_path (String) - Path to SQLite database
+        generator (Thumbnail) - Thumbnails generator
+        presets (List of strings) - Sizes of thumbnails as «SIZE» or
+        «SIZE:CROP» (crop is «fit» or «sized»)
+        formats (List of strings) - Other formats of thumbnails (e.g. WEBP)
+        workers (Integer number) - Count of worker threads in process
+        claim_timeout (Integer number) - Seconds to wait for claimed job
+        max_attempts (Integer number) - Attempts to generate thumbnail
+        """
+        super().__init__(db_path)
+        self.generator = generator
+        self.presets = [
+            tuple(p.split(':', 1)) if ':' in p else (p, None)
+            for p in presets
+        ]
+        self.formats = list(formats)
+        self.workers = workers
+        self.claim_timeout = claim_timeout
+        self.max_attempts = max_attempts
+        self._threads = []
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+
+    def put(self, path):
+        """Add jobs of all presets for image (real path)."""
+        if not self.presets:
+            return
+        relpath = os.path.relpath(path, app.config['ROOT_PATH'])
+        with self.connection() as conn:
+            conn.executemany(
+                'INSERT INTO jobs (path, size, crop) VALUES (?, ?, ?)',
+                [(relpath, size, crop) for size, crop in self.presets]
             )
-        ) if os.path.isdir(self.path) else os.stat(self.path).st_size
-        self.sizeFormatted = self.get_file_size(self.sizeBytes)
-        self.created = str(
-            datetime.fromtimestamp(
-                int(os.stat(self.path).st_ctime)
+        self.start()
+        self._wakeup.set()
+
+    def start(self):
+        """Start worker threads in current process (if not started)."""
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(
+                    target=self.work,
+                    name='thumbnails-%d' % (len(self._threads)),
+                    daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def claim(self):
+        """Take next job from queue or return None if queue is empty."""
+        conn = self.connection()
+        now = time.time()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            job = conn.execute(
+                'SELECT id, path, size, crop, attempts FROM jobs '
+                'WHERE claimed_at IS NULL OR claimed_at < ? '
+                'ORDER BY id LIMIT 1',
+                (now - self.claim_timeout,)
+            ).fetchone()
+            if job is not None:
+                conn.execute(
+                    'UPDATE jobs SET claimed_at = ?, attempts = attempts + 1 '
+                    'WHERE id = ?',
+                    (now, job[0])
+                )
+        return job
+
+    def work(self):
+        """Process jobs until thread is stopped."""
+        while True:
+            try:
+                job = self.claim()
+            except sqlite3.Error:
+                job = None
+            if job is None:
+                self._wakeup.wait(timeout=60)
+                self._wakeup.clear()
+                continue
+            job_id, path, size, crop, attempts = job
+            try:
+                if os.path.isfile(os.path.join(
+                    app.config['ROOT_PATH'],
+                    path
+                )):
+                    for image_format in [None] + self.formats:
+                        options = {'format': image_format} \
+                            if image_format else {}
+                        self.generator.get_thumbnail(
+                            path,
+                            size=size,
+                            crop=crop,
+                            **options
+                        )
+                done = True
+            except Exception:
+                app.logger.exception('Thumbnail job failed: %s', path)
+                done = attempts + 1 >= self.max_attempts
+            try:
+                with self.connection() as conn:
+                    if done:
+                        conn.execute(
+                            'DELETE FROM jobs WHERE id = ?',
+                            (job_id,)
+                        )
+                    else:
+                        conn.execute(
+                            'UPDATE jobs SET claimed_at = NULL WHERE id = ?',
+                            (job_id,)
+                        )
+            except sqlite3.Error:
+                pass
+
+
+class RenderCache:
+    """
+    Disk cache of rendered (watermarked) images.
+
+    Renders of one source file are stored in its own directory, so they are
+    invalidated all at once. Source modification time and size are part of
+    key, so changed sources never get stale renders. When total size of
+    cache exceeds limit, least recently used renders are deleted.
+    """
+
+    def __init__(self, root, max_size):
+        """Class description."""
+        self.root = root
+        self.max_size = max_size
+        self._size = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        """Class representation string."""
+        return "Render cache «%s»" % (self.root)
+
+    def directory(self, source):
+        """Get cache directory of source file renders."""
+        return os.path.join(
+            self.root,
+            os.path.relpath(source, app.config['ROOT_PATH'])
+        )
+
+    def path(self, source, key, extension='jpg'):
+        """
+        Get path to cached render of source file.
+
+        Parameters:
+        source (String) - Real path to source file
+        key (Tuple) - Render parameters
+        extension (String) - Extension of render file
+        """
+        stat = os.stat(source)
+        digest = hashlib.sha1(
+            repr((stat.st_mtime_ns, stat.st_size) + tuple(key)).encode()
+        ).hexdigest()
+        return os.path.join(
+            self.directory(source),
+            '%s.%s' % (digest, extension)
+        )
+
+    def get(self, source, key, extension='jpg'):
+        """Get path to cached render or None if it isn't cached."""
+        path = self.path(source, key, extension)
+        try:
+            # Время изменения используется как время последнего доступа
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def put(self, source, key, data, extension='jpg'):
+        """
+        Save render to cache atomically and return its path.
+
+        Parameters:
+        source (String) - Real path to source file
+        key (Tuple) - Render parameters
+        data (Bytes) - Rendered image
+        extension (String) - Extension of render file
+        """
+        path = self.path(source, key, extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            # Размер заменяемого рендера
+            old_size = os.stat(path).st_size
+        except OSError:
+            old_size = 0
+        temp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        with self._lock:
+            if self._size is not None:
+                self._size += len(data) - old_size
+            size = self._size
+        if size is None or size > self.max_size:
+            self.evict()
+        return path
+
+    def get_or_render(self, source, key, render, extension='jpg'):
+        """
+        Get path to cached render or render it and save to cache.
+
+        Only one process renders image, others wait and reuse it.
+
+        Parameters:
+        source (String) - Real path to source file
+        key (Tuple) - Render parameters
+        render (Function) - Function returning rendered image bytes
+        extension (String) - Extension of render file
+        """
+        path = self.get(source, key, extension)
+        if path is not None:
+            return path
+        with file_lock(self.path(source, key, extension)):
+            path = self.get(source, key, extension)
+            if path is None:
+                path = self.put(source, key, render(), extension)
+        return path
+
+    def evict(self):
+        """Delete least recently used renders while cache is over limit."""
+        renders = []
+        for directory, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                renders.append((stat.st_mtime_ns, stat.st_size, path))
+        size = sum(r[1] for r in renders)
+        if size > self.max_size:
+            renders.sort()
+            # Освобождаем с запасом, чтобы не чистить кэш на каждой записи
+            target = self.max_size * 0.9
+            for _, render_size, path in renders:
+                if size <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                size -= render_size
+        with self._lock:
+            self._size = size
+
+    def discard(self, source):
+        """Delete all renders of source file (or of directory contents)."""
+        directory = self.directory(source)
+        removed = 0
+        for subdirectory, _, filenames in os.walk(directory):
+            for filename in filenames:
+                path = os.path.join(subdirectory, filename)
+                try:
+                    size = os.stat(path).st_size
+                    os.remove(path)
+                except OSError:
+                    continue
+                removed += size
+        shutil.rmtree(directory, ignore_errors=True)
+        if removed:
+            with self._lock:
+                if self._size is not None:
+                    self._size = max(self._size - removed, 0)
+
+    def invalidate(self, path):
+        """Delete renders of changed or deleted source file."""
+        self.discard(path)
+
+
+render_cache = RenderCache(
+    app.config['RENDER_CACHE_ROOT'],
+    app.config['RENDER_CACHE_MAX_SIZE']
+)
+
+
+class UploadSessions(SQLiteStorage):
+    """
+    Sessions of resumable (chunked) uploads.
+
+    Data is written directly into pre-allocated part file, which is
+    renamed to target path on finalization. Chunks must be sent in order,
+    SHA-512 of received data is computed while chunks arrive. Hash state
+    lives in process memory; if chunk comes to other process (or after
+    restart), hash is restored by reading received part once.
+    """
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS uploads ('
+        'id TEXT PRIMARY KEY, path TEXT, name TEXT, size INTEGER, '
+        'offset INTEGER DEFAULT 0, created REAL)',
+    )
+
+    def __init__(self, db_path, root, ttl=24 * 60 * 60):
+        """
+        Class description.
+
+        Parameters:
+        db_path (String) - Path to SQLite database
+        root (String) - Directory of part files
+        ttl (Integer number) - Seconds after which session is expired
+        """
+        super().__init__(db_path)
+        self.root = root
+        self.ttl = ttl
+        self._hashes = {}
+        self._lock = threading.Lock()
+
+    def part_path(self, upload_id):
+        """Get path to part file of upload."""
+        return os.path.join(self.root, '%s.part' % (upload_id))
+
+    def create(self, path, name, size):
+        """
+        Create upload session and pre-allocate part file.
+
+        Parameters:
+        path (String) - Real path to target file
+        name (String) - Original name of uploaded file
+        size (Integer number) - Size of uploaded file in bytes
+        """
+        self.cleanup()
+        upload_id = uuid.uuid4().hex
+        os.makedirs(self.root, exist_ok=True)
+        fd = os.open(
+            self.part_path(upload_id),
+            os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+            0o644
+        )
+        try:
+            if size > 0:
+                if hasattr(os, 'posix_fallocate'):
+                    os.posix_fallocate(fd, 0, size)
+                else:
+                    os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+        with self.connection() as conn:
+            conn.execute(
+                'INSERT INTO uploads (id, path, name, size, created) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (upload_id, path, name, size, time.time())
             )
+        with self._lock:
+            self._hashes[upload_id] = (0, hashlib.sha512())
+        return upload_id
+
+    def get(self, upload_id):
+        """Get session data in dictionary or None if it doesn't exist."""
+        row = self.connection().execute(
+            'SELECT id, path, name, size, offset, created FROM uploads '
+            'WHERE id = ?',
+            (upload_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(
+            ('id', 'path', 'name', 'size', 'offset', 'created'),
+            row
+        ))
+
+    def hasher(self, upload_id, offset):
+        """Get hash object of first «offset» bytes of part file."""
+        with self._lock:
+            state = self._hashes.pop(upload_id, None)
+        if state is None or state[0] > offset:
+            state = (0, hashlib.sha512())
+        hashed, hash = state
+        if hashed < offset:
+            with open(self.part_path(upload_id), 'rb') as f:
+                f.seek(hashed)
+                remaining = offset - hashed
+                while remaining > 0:
+                    chunk = f.read(min(remaining, 1024 * 1024))
+                    if not chunk:
+                        break
+                    hash.update(chunk)
+                    remaining -= len(chunk)
+        return hash
+
+    def write(self, upload_id, start, stream, length, chunk_size=1024 * 1024):
+        """
+        Write chunk of data to part file and return new offset.
+
+        Parameters:
+        upload_id (String) - Upload session ID
+        start (Integer number) - Position of chunk (must be current offset)
+        stream (File-like object) - Chunk data stream
+        length (Integer number) - Length of chunk in bytes
+        chunk_size (Integer number) - Size of read buffer
+        """
+        # Части одной сессии пишутся по очереди во всех процессах
+        with file_lock(upload_id):
+            session = self.get(upload_id)
+            if start != session['offset']:
+                raise ValueError(session['offset'])
+            if start + length > session['size']:
+                raise OverflowError(session['size'])
+            hash = self.hasher(upload_id, start)
+            offset = start
+            fd = os.open(self.part_path(upload_id), os.O_WRONLY)
+            try:
+                while offset < start + length:
+                    chunk = stream.read(
+                        min(chunk_size, start + length - offset)
+                    )
+                    if not chunk:
+                        break
+                    os.pwrite(fd, chunk, offset)
+                    hash.update(chunk)
+                    offset += len(chunk)
+            finally:
+                os.close(fd)
+            with self.connection() as conn:
+                conn.execute(
+                    'UPDATE uploads SET offset = ? WHERE id = ?',
+                    (offset, upload_id)
+                )
+            with self._lock:
+                self._hashes[upload_id] = (offset, hash)
+        return offset
+
+    def finalize(self, upload_id):
+        """
+        Move completely received file to target path.
+
+        Returns tuple of target path and SHA-512 hash of file.
+        """
+        with file_lock(upload_id):
+            session = self.get(upload_id)
+            if session['offset'] != session['size']:
+                raise ValueError(session['offset'])
+            digest = self.hasher(upload_id, session['offset']).hexdigest()
+            os.makedirs(os.path.dirname(session['path']), exist_ok=True)
+            shutil.move(self.part_path(upload_id), session['path'])
+            self.discard(upload_id)
+        return session['path'], digest
+
+    def discard(self, upload_id):
+        """Delete session and its part file."""
+        with self._lock:
+            self._hashes.pop(upload_id, None)
+        with self.connection() as conn:
+            conn.execute('DELETE FROM uploads WHERE id = ?', (upload_id,))
+        try:
+            os.remove(self.part_path(upload_id))
+        except OSError:
+            pass
+
+    def cleanup(self):
+        """Delete expired sessions."""
+        expired = self.connection().execute(
+            'SELECT id FROM uploads WHERE created < ?',
+            (time.time() - self.ttl,)
+        ).fetchall()
+        for row in expired:
+            self.discard(row[0])
+
+
+upload_sessions = UploadSessions(
+    app.config['UPLOADS_INDEX_FILE'],
+    app.config['UPLOADS_ROOT'],
+    app.config['UPLOAD_SESSION_TTL']
+)
+
+
+class FileSystemWatcher:
+    """
+    Watcher of changes in root directory made outside of API.
+
+    Changed paths are published to subscribers, which have
+    «invalidate(path)» method (caches of derived data). Changes are got
+    from inotify (Linux, via libc) or by periodical comparison of tree
+    snapshots (inodes, sizes and modification times). Service directories
+    (thumbnails, indexes, caches) are not watched. If events are lost
+    (inotify queue overflow), subscribers are reset: their «reset()»
+    method is called or whole root is invalidated.
+
+    Only one process watches tree: watcher threads of other processes wait
+    for lock file and take over when it is released.
+    """
+
+    # Маски событий inotify, см. inotify(7)
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+        IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+    def __init__(
+            self, root, subscribers=(), ignored=(), backend='auto',
+            interval=5, lock_path=None
+    ):
+        """
+        Class description.
+
+        Parameters:
+        root (String) - Watched directory
+        subscribers (List) - Objects with «invalidate(path)» method
+        ignored (List of strings) - Not watched directories
+        backend (String) - «inotify», «polling» or «auto» (inotify if
+        available)
+        interval (Number) - Seconds between snapshots in polling mode
+        lock_path (String) - Lock file of watching process (every process
+        watches tree if not given)
+        """
+        self.root = os.path.normpath(root)
+        self.subscribers = list(subscribers)
+        self.ignored = [os.path.normpath(p) for p in ignored]
+        self.backend = backend
+        self.interval = interval
+        self.lock_path = lock_path
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        """Class representation string."""
+        return "File system watcher «%s» (%s)" % (self.root, self.backend)
+
+    def subscribe(self, subscriber):
+        """Add object with «invalidate(path)» method to subscribers."""
+        self.subscribers.append(subscriber)
+
+    def ignores(self, path):
+        """Check if path is in one of ignored directories."""
+        return any(
+            path == p or path.startswith(p + os.sep) for p in self.ignored
         )
-        self.modified = str(
-            datetime.fromtimestamp(
-                int(os.stat(self.path).st_mtime)
+
+    def publish(self, paths):
+        """Send changed paths to all subscribers."""
+        for path in sorted(paths):
+            for subscriber in self.subscribers:
+                try:
+                    subscriber.invalidate(path)
+                except Exception:
+                    app.logger.exception(
+                        'Invalidation failed: %r, %s',
+                        subscriber,
+                        path
+                    )
+
+    def reset(self):
+        """Reset all subscribers after lost events."""
+        for subscriber in self.subscribers:
+            try:
+                if hasattr(subscriber, 'reset'):
+                    subscriber.reset()
+                else:
+                    subscriber.invalidate(self.root)
+            except Exception:
+                app.logger.exception('Reset failed: %r', subscriber)
+
+    def start(self):
+        """Start watcher thread in current process (if not started)."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(
+                target=self.run,
+                name='watcher',
+                daemon=True
             )
+            self._thread.start()
+
+    def run(self):
+        """Wait for lock of watching process and watch tree."""
+        if self.lock_path is None:
+            return self.watch()
+        os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+        with open(self.lock_path, 'a') as lock:
+            # Блокировка снимается системой при завершении процесса,
+            # тогда наблюдение продолжает другой процесс
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self.watch()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def watch(self):
+        """Watch tree by inotify or polling (according to backend)."""
+        watch = self.watch_polling
+        if self.backend in ('auto', 'inotify'):
+            try:
+                watch = self.inotify()
+            except (OSError, AttributeError):
+                if self.backend == 'inotify':
+                    app.logger.exception('Inotify is unavailable')
+                    return
+        watch()
+
+    def inotify(self):
+        """Create inotify instance and return function reading its events."""
+        libc = ctypes.CDLL(
+            ctypes.util.find_library('c') or 'libc.so.6',
+            use_errno=True
         )
-        if os.path.isfile(self.path):
-            self.hash = self.file_hash()
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        watches = {}
+
+        def add_tree(path):
+            for directory, subdirectories, _ in os.walk(path):
+                subdirectories[:] = [
+                    d for d in subdirectories
+                    if not self.ignores(os.path.join(directory, d))
+                ]
+                wd = libc.inotify_add_watch(
+                    fd,
+                    os.fsencode(directory),
+                    self.WATCH_MASK
+                )
+                if wd >= 0:
+                    watches[wd] = directory
+
+        add_tree(self.root)
+
+        def watch():
+            header = struct.Struct('iIII')
+            while True:
+                data = os.read(fd, 64 * 1024)
+                changed = set()
+                overflow = False
+                offset = 0
+                while offset < len(data):
+                    wd, mask, _, length = header.unpack_from(data, offset)
+                    name = data[
+                        offset + header.size:offset + header.size + length
+                    ].rstrip(b'\0')
+                    offset += header.size + length
+                    if mask & self.IN_Q_OVERFLOW:
+                        # События потеряны: размеры директорий и кэш
+                        # рендеров сбрасываются, устаревшие миниатюры
+                        # удаляются, поисковый индекс строится заново.
+                        # Записи индекса метаданных сверяются с stat при
+                        # чтении
+                        overflow = True
+                        continue
+                    if mask & self.IN_IGNORED:
+                        watches.pop(wd, None)
+                        continue
+                    directory = watches.get(wd)
+                    if directory is None:
+                        continue
+                    path = os.path.join(directory, os.fsdecode(name)) \
+                        if name else directory
+                    if self.ignores(path):
+                        continue
+                    if mask & self.IN_ISDIR and \
+                            mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                        add_tree(path)
+                    changed.add(path)
+                if overflow:
+                    self.reset()
+                else:
+                    self.publish(changed)
+
+        return watch
+
+    def snapshot(self):
+        """Get inodes, sizes and modification times of all tree objects."""
+        result = {}
+        stack = [self.root]
+        while stack:
+            try:
+                with os.scandir(stack.pop()) as entries:
+                    for entry in entries:
+                        if self.ignores(entry.path):
+                            continue
+                        try:
+                            stat = entry.stat(follow_symlinks=False)
+                        except OSError:
+                            continue
+                        result[entry.path] = (
+                            stat.st_ino,
+                            stat.st_size,
+                            stat.st_mtime_ns
+                        )
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+            except OSError:
+                pass
+        return result
+
+    def watch_polling(self):
+        """Compare tree snapshots and publish changed paths."""
+        previous = self.snapshot()
+        while True:
+            time.sleep(self.interval)
+            current = self.snapshot()
+            self.publish(
+                p for p in previous.keys() | current.keys()
+                if previous.get(p) != current.get(p)
+            )
+            previous = current
+
+
+class FileSystemObject:
+    """
+    Class describing files and directories on filesystem as objects.
+
+    All attributes are computed lazily on first access and share one
+    «os.stat» call, so only requested metadata fields cost anything.
+    Objects have no «__dict__» and keep only raw numbers (sizes and times in
+    nanoseconds), values are formatted when metadata is serialized, so
+    lists of big directories take little memory.
+    """
+
+    __slots__ = (
+        'path', 'name', '_entry', '_is_directory', '_ino', '_size',
+        '_mtime_ns', '_ctime_ns', '_total', '_indexed', '_link'
+    )
+
+    fields = (
+        'name',
+        'path',
+        'type',
+        'link',
+        'sizeBytes',
+        'sizeNumber',
+        'sizeSuffix',
+        'created',
+        'modified',
+        'hash'
+    )
+
+    def __init__(self, path, stat=None, entry=None):
+        """
+        Class description.
+
+        Parameters:
+        path (String) - Real path to file or directory
+        stat (os.stat_result) - Already known stat of object (optional)
+        entry (os.DirEntry) - Directory entry from «os.scandir», its cached
+        data is used instead of system calls (optional)
+        """
+        self.path = path
+        self.name = entry.name if entry is not None \
+            else path.rsplit('/', maxsplit=1)[-1]
+        self._entry = entry
+        self._is_directory = None
+        self._size = None
+        self._total = None
+        self._indexed = None
+        self._link = None
+        if stat is not None:
+            self.load(stat)
 
     def __repr__(self):
         """Class representation string."""
         return "File system object «%s»" % (self.name)
 
-    def get_metadata(self):
-        """Get class data in json dictionary."""
-        returned_dict = {
-            "name": self.name,
-            "path": self.path,
-            "type": self.type,
-            "link": self.link,
-            "sizeBytes": self.sizeBytes,
-            "sizeNumber": self.sizeFormatted['number'],
-            "sizeSuffix": self.sizeFormatted['suffix'],
-            "created": self.created,
-            "modified": self.modified,
-        }
-        if hasattr(self, 'hash'):
-            returned_dict["hash"] = self.hash
+    def load(self, stat=None):
+        """Save raw values of stat, shared by all attributes."""
+        if stat is None:
+            stat = self._entry.stat() if self._entry is not None \
+                else os.stat(self.path)
+        self._ino = stat.st_ino
+        self._size = stat.st_size
+        self._mtime_ns = stat.st_mtime_ns
+        self._ctime_ns = stat.st_ctime_ns
+        if self._is_directory is None:
+            self._is_directory = S_ISDIR(stat.st_mode)
+        # Данные записи директории больше не нужны
+        self._entry = None
+
+    @property
+    def stat(self):
+        """Stat values used by metadata index."""
+        if self._size is None:
+            self.load()
+        return IndexedStat(self._ino, self._size, self._mtime_ns)
+
+    @property
+    def is_directory(self):
+        """Object is directory."""
+        if self._is_directory is None:
+            if self._entry is not None:
+                self._is_directory = self._entry.is_dir()
+            else:
+                self.load()
+        return self._is_directory
+
+    @property
+    def mtime_ns(self):
+        """Modification time in nanoseconds."""
+        if self._size is None:
+            self.load()
+        return self._mtime_ns
+
+    @property
+    def ctime_ns(self):
+        """Creation (metadata change) time in nanoseconds."""
+        if self._size is None:
+            self.load()
+        return self._ctime_ns
+
+    def from_index(self, key, compute):
+        """Get indexed value or compute it and save to index."""
+        if self._indexed is None:
+            self._indexed = metadata_index.get(self.path, self.stat) or {}
+        if self._indexed.get(key) is None:
+            self._indexed[key] = compute()
+            metadata_index.set(self.path, self.stat, **self._indexed)
+        return self._indexed[key]
+
+    @property
+    def type(self):
+        """MIME type of file or «directory»."""
+        if self.is_directory:
+            return 'directory'
+        return self.from_index(
+            'type',
+            lambda: magic.from_file(self.path, mime=True)
+        )
+
+    @property
+    def link(self):
+        """API link to object."""
+        if self._link is None:
+            relpath = os.path.relpath(self.path, app.config['ROOT_PATH'])
+            self._link = url_for(
+                '.get_file',
+                asked_file_path=relpath if relpath != os.curdir else None,
+                _external=True
+            )
+        return self._link
+
+    @property
+    def sizeBytes(self):
+        """Size of file or total size of directory in bytes."""
+        if self.is_directory:
+            if self._total is None:
+                self._total = directory_sizes.get(self.path)
+            return self._total
+        if self._size is None:
+            self.load()
+        return self._size
+
+    @property
+    def sizeFormatted(self):
+        """Size with auto detected measure unit."""
+        return self.get_file_size(self.sizeBytes)
+
+    @property
+    def created(self):
+        """Creation (metadata change) datetime string."""
+        return self.format_time(self.ctime_ns)
+
+    @property
+    def modified(self):
+        """Modification datetime string."""
+        return self.format_time(self.mtime_ns)
+
+    @property
+    def hash(self):
+        """SHA-512 hash of file (None for directories)."""
+        if self.is_directory:
+            return None
+        return self.from_index('hash', self.file_hash)
+
+    def prefetch(self, fields=None):
+        """
+        Compute metadata fields without formatting them.
+
+        API link is skipped because it needs request context, so method
+        can be called in worker threads.
+
+        Parameters:
+        fields (List of strings) - Fields to compute (all if None)
+        """
+        fields = self.fields if fields is None else fields
+        for field in fields:
+            if field in ('sizeBytes', 'sizeNumber', 'sizeSuffix'):
+                self.sizeBytes
+            elif field in ('created', 'modified'):
+                self.mtime_ns
+            elif field in ('type', 'hash'):
+                getattr(self, field)
+        return self
+
+    def get_metadata(self, fields=None):
+        """
+        Get class data in json dictionary.
+
+        Parameters:
+        fields (List of strings) - Return only these fields (all if None)
+        """
+        fields = self.fields if fields is None else fields
+        returned_dict = {}
+        size_formatted = None
+        for field in fields:
+            if field in ('sizeNumber', 'sizeSuffix'):
+                if size_formatted is None:
+                    size_formatted = self.sizeFormatted
+                returned_dict[field] = size_formatted[field[4:].lower()]
+            elif field == 'hash':
+                if not self.is_directory:
+                    returned_dict[field] = self.hash
+            elif field in self.fields:
+                returned_dict[field] = getattr(self, field)
         return returned_dict
 
+    @staticmethod
+    def format_time(time_ns):
+        """Get datetime string of time in nanoseconds."""
+        return str(datetime.fromtimestamp(time_ns // 1000000000))
+
     def get_file_size(self, num, suffix='B'):
         """Get size in json dictionary with auto detecting measure unit."""
         for unit in ['', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi']:
@@ -88,3 +1927,188 @@ class FileSystemObject:
             for chunk in iter(lambda: f.read(4096), b""):
                 hash.update(chunk)
         return hash.hexdigest()
+
+
+class ListingQuery:
+    """
+    Compiled search («q») and sorting («sf») parameters of files list.
+
+    Parameters are parsed once into typed conditions and composite sorting
+    key, which work with rows (tuples of raw field values ending with
+    object) instead of metadata dictionaries. Search values:
+    name, sizeSuffix - substring, glob («*.jpg») or regular expression
+    («/^img_\\d+/»);
+    type - substring or MIME prefix («image/», «image/*»);
+    sizeBytes, sizeNumber - number, comparison («>100», «<=100») or range
+    («100..2000», any bound can be omitted);
+    created, modified - date or its beginning («2021», «2021-05»,
+    «2021-05-03T10:00»), comparison or range of dates.
+    """
+
+    # Типы полей, атрибуты объекта с их значениями (времена в наносекундах)
+    # и функции для полей, которых нет среди атрибутов
+    field_types = {
+        'name': 'text',
+        'type': 'mime',
+        'sizeBytes': 'number',
+        'sizeNumber': 'number',
+        'sizeSuffix': 'text',
+        'created': 'date',
+        'modified': 'date'
+    }
+    attributes = {
+        'name': 'name',
+        'type': 'type',
+        'sizeBytes': 'sizeBytes',
+        'created': 'ctime_ns',
+        'modified': 'mtime_ns'
+    }
+    getters = {
+        'sizeNumber': lambda o: o.sizeFormatted['number'],
+        'sizeSuffix': lambda o: o.sizeFormatted['suffix']
+    }
+    # Форматы дат и длительность периода, который задает каждый из них
+    date_formats = (
+        ('%Y-%m-%d %H:%M:%S', 'second'),
+        ('%Y-%m-%d %H:%M', 'minute'),
+        ('%Y-%m-%d %H', 'hour'),
+        ('%Y-%m-%d', 'day'),
+        ('%Y-%m', 'month'),
+        ('%Y', 'year')
+    )
+
+    def __init__(self, search_params=None, sorting_params=('name',)):
+        """
+        Class description.
+
+        Raises ValueError if search value is incorrect.
+
+        Parameters:
+        search_params (Dictionary) - Search values by fields
+        sorting_params (List of strings) - Sorting fields
+        """
+        search_params = search_params or {}
+        # Поля сортировки идут первыми, ключ сортировки - начало строки
+        self.fields = list(sorting_params) + [
+            k for k in search_params if k not in sorting_params
+        ]
+        self.conditions = [
+            (self.fields.index(k), self.condition(k, v))
+            for k, v in search_params.items()
+        ]
+        # Строка и ключ собираются функциями operator (без цикла в Python)
+        self.sort_key = itemgetter(slice(0, len(sorting_params)))
+        if all(k in self.attributes for k in self.fields):
+            get = attrgetter(*[self.attributes[k] for k in self.fields])
+            if len(self.fields) == 1:
+                self.row = lambda obj: (get(obj), obj)
+            else:
+                self.row = lambda obj: get(obj) + (obj,)
+        if len(self.conditions) == 1:
+            index, test = self.conditions[0]
+            self.matches = lambda row: test(row[index])
+        elif len(self.conditions) == 2:
+            (first, test), (second, other_test) = self.conditions
+            self.matches = lambda row: test(row[first]) and \
+                other_test(row[second])
+
+    def __repr__(self):
+        """Class representation string."""
+        return "Listing query (fields: %s)" % (', '.join(self.fields))
+
+    def row(self, obj):
+        """Get row of object (can be called in worker threads)."""
+        return tuple(
+            self.getters[k](obj) if k in self.getters
+            else attrgetter(self.attributes[k])(obj)
+            for k in self.fields
+        ) + (obj,)
+
+    def matches(self, row):
+        """Check if row satisfies all search conditions."""
+        return all(test(row[i]) for i, test in self.conditions)
+
+    @classmethod
+    def condition(cls, field, value):
+        """Compile search value of field into test function."""
+        kind = cls.field_types[field]
+        if kind == 'text':
+            if len(value) > 1 and value.startswith('/') and \
+                    value.endswith('/'):
+                return re.compile(value[1:-1]).search
+            if any(c in value for c in '*?['):
+                return re.compile(fnmatch.translate(value)).match
+            return lambda v: value in v
+        if kind == 'mime':
+            if value.endswith('/*'):
+                value = value[:-1]
+            if value.endswith('/'):
+                return lambda v: v.startswith(value)
+            return lambda v: value in v
+        if value[:2] in ('>=', '<='):
+            limits = [(value[:2], value[2:])]
+        elif value[:1] in ('>', '<'):
+            limits = [(value[:1], value[1:])]
+        elif '..' in value:
+            low, high = value.split('..', 1)
+            limits = [('>=', low), ('<=', high)]
+        else:
+            limits = [('>=', value), ('<=', value)]
+        comparisons = []
+        for operator, bound in limits:
+            if not bound:
+                continue
+            if kind == 'number':
+                comparisons.append((operator, float(bound)))
+            else:
+                # Дата задает период [начало, конец): «>» - не раньше конца,
+                # «<=» - раньше конца и т.д.
+                start, end = cls.date_range(bound)
+                comparisons.append({
+                    '>=': ('>=', start),
+                    '>': ('>=', end),
+                    '<': ('<', start),
+                    '<=': ('<', end)
+                }[operator])
+        tests = [cls.comparison(o, b) for o, b in comparisons]
+        if not tests:
+            raise ValueError('Empty range: %s' % (value))
+        if len(tests) == 1:
+            return tests[0]
+        low, high = tests
+        return lambda v: low(v) and high(v)
+
+    @staticmethod
+    def comparison(operator, bound):
+        """Get test function of comparison with bound."""
+        if operator == '>=':
+            return lambda v: v >= bound
+        if operator == '>':
+            return lambda v: v > bound
+        if operator == '<=':
+            return lambda v: v <= bound
+        return lambda v: v < bound
+
+    @classmethod
+    def date_range(cls, value):
+        """Get times (ns) of beginning and end of period set by date."""
+        value = value.replace('T', ' ')
+        for date_format, period in cls.date_formats:
+            try:
+                start = datetime.strptime(value, date_format)
+            except ValueError:
+                continue
+            if period == 'year':
+                end = start.replace(year=start.year + 1)
+            elif period == 'month':
+                end = start.replace(
+                    year=start.year + start.month // 12,
+                    month=start.month % 12 + 1
+                )
+            else:
+                end = start + timedelta(**{period + 's': 1})
+            return (
+                int(start.timestamp()) * 1000000000,
+                int(end.timestamp()) * 1000000000
+            )
+        raise ValueError('Incorrect date: %s' % (value))
@@ -1,15 +1,82 @@
 """CDNAPI utils file."""
 
+import base64
+import fcntl
+import hashlib
+import heapq
 import math
+import mimetypes
+import os
+import re
+import threading
 import traceback
 import io
+import uuid
 
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
 from distutils.util import strtobool
-from urllib.parse import urljoin
+from urllib.parse import quote, urlencode
 from PIL import Image, ImageEnhance, ImageDraw, ImageFont
-from flask import Response, json, request
+from flask import Response, json, request, send_file
 from app import app
 
+# Output formats of derived images: MIME type and file extension
+IMAGE_FORMATS = {
+    'JPEG': ('image/jpeg', 'jpg'),
+    'PNG': ('image/png', 'png'),
+    'WEBP': ('image/webp', 'webp'),
+    'AVIF': ('image/avif', 'avif'),
+}
+
+
+def json_backend(name='auto'):
+    """
+    Get function encoding value to JSON (UTF-8 bytes) by chosen library.
+
+    Parameters:
+    name (String) - «orjson», «ujson», «json» (standard library through
+    Flask) or «auto» (the fastest of installed ones)
+    """
+    sort_keys = app.config.get('JSON_SORT_KEYS', True)
+    if name in ('auto', 'orjson'):
+        try:
+            import orjson
+        except ImportError:
+            if name == 'orjson':
+                raise
+        else:
+            option = orjson.OPT_SORT_KEYS if sort_keys else 0
+            return lambda value: orjson.dumps(value, option=option)
+    if name in ('auto', 'ujson'):
+        try:
+            import ujson
+        except ImportError:
+            if name == 'ujson':
+                raise
+        else:
+            return lambda value: ujson.dumps(
+                value,
+                ensure_ascii=False,
+                escape_forward_slashes=False,
+                sort_keys=sort_keys
+            ).encode('utf-8')
+    # Кодировщик Flask создается один раз: json.dumps делает это на каждый
+    # вызов, что заметно при кодировании списка по элементам
+    encode = app.json_encoder(ensure_ascii=False, sort_keys=sort_keys).encode
+    return lambda value: encode(value).encode('utf-8')
+
+
+# Кодирование ответов в JSON сразу в байты
+json_dumps = json_backend(app.config['JSON_BACKEND'])
+
+metadata_executor = ThreadPoolExecutor(
+    max_workers=app.config['METADATA_WORKERS'],
+    thread_name_prefix='metadata'
+) if app.config['METADATA_WORKERS'] > 1 else None
+
 
 def json_http_response(dbg=False, given_message=None, status=500):
     """
@@ -20,7 +87,7 @@ def json_http_response(dbg=False, given_message=None, status=500):
     given_message (String) - Response text
     status (Integer number) - Response status
     """
-    if status in (400, 401, 403, 404, 500):
+    if status in (400, 401, 403, 404, 409, 500, 503):
         response_type = 'Error'
         if status == 400:
             message = 'Bad request!'
@@ -30,8 +97,12 @@ def json_http_response(dbg=False, given_message=None, status=500):
             message = 'Forbidden'
         if status == 404:
             message = 'Not found!'
+        if status == 409:
+            message = 'Conflict!'
         if status == 500:
             message = 'Internal server error!'
+        if status == 503:
+            message = 'Service unavailable!'
     elif status in (200, 201):
         response_type = 'Success'
         if status == 200:
@@ -66,12 +137,380 @@ def json_http_response(dbg=False, given_message=None, status=500):
                 "(should be boolean)"
 
     return Response(
-        response=json.dumps(info),
+        response=json_dumps(info),
         status=status,
         mimetype='application/json'
     )
 
 
+def ordered_map(func, items, window=None):
+    """
+    Apply function to items in metadata worker pool keeping items order.
+
+    Not more than «window» items of one call are processed at once, so
+    one big request cannot occupy the whole pool.
+
+    Parameters:
+    func (Function) - function to apply (must not need request context)
+    items (Iterable) - items to process
+    window (Integer number) - maximum of simultaneously processed items
+    """
+    if window is None:
+        window = app.config['METADATA_REQUEST_WORKERS']
+    if metadata_executor is None or window <= 1:
+        yield from map(func, items)
+        return
+    pending = deque()
+    for item in items:
+        pending.append(metadata_executor.submit(func, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def service_paths():
+    """Get real paths of service directories (indexes, caches, locks)."""
+    return [os.path.normpath(p) for p in (
+        os.path.join(app.config['ROOT_PATH'], app.config['INDEX_FOLDER']),
+        app.config['THUMBNAIL_MEDIA_THUMBNAIL_ROOT'],
+        app.config['RENDER_CACHE_ROOT'],
+        app.config['LOCKS_ROOT'],
+        app.config['UPLOADS_ROOT']
+    )]
+
+
+def is_service_path(path):
+    """Check if real path is service directory or is inside of one."""
+    path = os.path.normpath(path)
+    return any(
+        path == p or path.startswith(p + os.sep) for p in service_paths()
+    )
+
+
+@contextmanager
+def file_lock(name, stripes=1024):
+    """
+    Exclusive lock by name, shared by all threads and processes.
+
+    Locks are striped over fixed set of lock files, so their count
+    doesn't grow. Waits until lock is released by other holder.
+
+    Parameters:
+    name (String) - Name of locked resource (e.g. path to rendered file)
+    stripes (Integer number) - Count of lock files
+    """
+    stripe = int(hashlib.sha1(name.encode('utf-8')).hexdigest(), 16) % stripes
+    os.makedirs(app.config['LOCKS_ROOT'], exist_ok=True)
+    with open(
+        os.path.join(app.config['LOCKS_ROOT'], '%04d.lock' % (stripe)),
+        'a'
+    ) as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def entity_tag(*parts):
+    """Make entity tag (ETag) value from given parts."""
+    return hashlib.sha1(
+        '\0'.join(str(p) for p in parts).encode('utf-8')
+    ).hexdigest()
+
+
+def last_modified_time(stat):
+    """Get «Last-Modified» datetime (naive UTC) from stat of object."""
+    return datetime.utcfromtimestamp(int(stat.st_mtime))
+
+
+def not_modified_response(etag, last_modified=None, weak=False):
+    """
+    Get «304 Not modified» response if client has actual representation.
+
+    «If-None-Match» has priority over «If-Modified-Since». Returns None if
+    full response should be sent.
+
+    Parameters:
+    etag (String) - Entity tag of current representation
+    last_modified (Datetime) - Modification time of representation
+    weak (Boolean) - Entity tag is weak
+    """
+    if request.if_none_match:
+        if not request.if_none_match.contains_weak(etag):
+            return None
+    else:
+        if_modified_since = request.if_modified_since
+        if if_modified_since is None or last_modified is None:
+            return None
+        if if_modified_since.tzinfo is not None:
+            if_modified_since = if_modified_since.astimezone(
+                timezone.utc
+            ).replace(tzinfo=None)
+        if last_modified > if_modified_since:
+            return None
+    return conditional_headers(
+        Response(status=304),
+        etag,
+        last_modified,
+        weak
+    )
+
+
+def conditional_headers(response, etag, last_modified=None, weak=False):
+    """
+    Add «ETag» and «Last-Modified» headers to response.
+
+    Parameters:
+    response (Response) - Response object
+    etag (String) - Entity tag of representation
+    last_modified (Datetime) - Modification time of representation
+    weak (Boolean) - Entity tag is weak
+    """
+    response.set_etag(etag, weak=weak)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+
+def deliver_file(path, mimetype=None, etag=None, last_modified=None):
+    """
+    Send file by configured delivery backend.
+
+    With «x-accel-redirect» or «x-sendfile» backend response has empty body
+    and front proxy sends file itself, so worker is released at once.
+    With «wsgi» backend file is given to «wsgi.file_wrapper» of server
+    (it uses sendfile where possible) and «Range» requests are served by
+    positional reads.
+
+    Parameters:
+    path (String) - Real path to file
+    mimetype (String) - MIME type of file (guessed by name if not given)
+    etag (String) - Strong entity tag of file, enables «Range» support
+    last_modified (Datetime) - Modification time of file (for «If-Range»)
+    """
+    backend = app.config['FILE_DELIVERY_BACKEND']
+    if mimetype is None:
+        mimetype = mimetypes.guess_type(path)[0] or \
+            'application/octet-stream'
+
+    if backend == 'x-accel-redirect':
+        relpath = os.path.relpath(path, app.config['ROOT_PATH'])
+        # Nginx отдает только файлы из внутренней location корня
+        if not relpath.startswith(os.pardir + os.sep):
+            response = Response(status=200, mimetype=mimetype)
+            response.headers['X-Accel-Redirect'] = quote(
+                app.config['FILE_DELIVERY_ACCEL_ROOT'].rstrip('/') + '/' +
+                relpath.replace(os.sep, '/')
+            )
+            return response
+    elif backend == 'x-sendfile':
+        response = Response(status=200, mimetype=mimetype)
+        response.headers['X-Sendfile'] = path
+        response.content_length = os.stat(path).st_size
+        return response
+
+    if etag is not None and request.range is not None:
+        return range_response(path, mimetype, etag, last_modified)
+    response = send_file(path, mimetype=mimetype, add_etags=False)
+    response.accept_ranges = 'bytes'
+    return response
+
+
+def byte_ranges(ranges, length):
+    """
+    Get satisfiable byte ranges as list of (start, stop) tuples.
+
+    Parameters:
+    ranges (List) - Ranges of parsed «Range» header
+    length (Integer number) - Length of file in bytes
+    """
+    result = []
+    for start, stop in ranges:
+        if stop is None:
+            stop = length
+            if start < 0:
+                start = max(length + start, 0)
+        stop = min(stop, length)
+        if start < stop:
+            result.append((start, stop))
+    return result
+
+
+def read_range(path, start, stop, chunk_size=256 * 1024):
+    """
+    Read part of file by positional reads without changing file position.
+
+    Parameters:
+    path (String) - Real path to file
+    start (Integer number) - First byte of part
+    stop (Integer number) - Byte after the last one of part
+    chunk_size (Integer number) - Size of read chunks in bytes
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        while start < stop:
+            chunk = os.pread(fd, min(chunk_size, stop - start), start)
+            if not chunk:
+                break
+            start += len(chunk)
+            yield chunk
+    finally:
+        os.close(fd)
+
+
+def range_response(path, mimetype, etag, last_modified=None):
+    """
+    Get response to request with «Range» header.
+
+    Returns «206 Partial Content» response (one part or
+    «multipart/byteranges»), «416» if no range is satisfiable and full
+    file if «If-Range» doesn`t match current representation.
+
+    Parameters:
+    path (String) - Real path to file
+    mimetype (String) - MIME type of file
+    etag (String) - Strong entity tag of file
+    last_modified (Datetime) - Modification time of file
+    """
+    if_range = request.if_range
+    if if_range.etag is not None:
+        matches = if_range.etag == etag
+    elif if_range.date is not None:
+        if_range_date = if_range.date
+        if if_range_date.tzinfo is not None:
+            if_range_date = if_range_date.astimezone(
+                timezone.utc
+            ).replace(tzinfo=None)
+        matches = if_range_date == last_modified
+    else:
+        matches = True
+
+    length = os.stat(path).st_size
+    ranges = byte_ranges(request.range.ranges, length) \
+        if request.range.units == 'bytes' else None
+    if not matches or ranges is None or \
+            len(ranges) > app.config['MAX_BYTE_RANGES']:
+        response = send_file(path, mimetype=mimetype, add_etags=False)
+        response.accept_ranges = 'bytes'
+        return response
+    if not ranges:
+        response = Response(status=416)
+        response.headers['Content-Range'] = 'bytes */%s' % (length)
+        response.accept_ranges = 'bytes'
+        return response
+
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        response = Response(
+            read_range(path, start, stop),
+            status=206,
+            mimetype=mimetype,
+            direct_passthrough=True
+        )
+        response.content_range = 'bytes %s-%s/%s' % (start, stop - 1, length)
+        response.content_length = stop - start
+    else:
+        boundary = uuid.uuid4().hex
+        headers = [
+            (
+                '--%s\r\nContent-Type: %s\r\n'
+                'Content-Range: bytes %s-%s/%s\r\n\r\n' % (
+                    boundary, mimetype, start, stop - 1, length
+                )
+            ).encode('latin-1')
+            for start, stop in ranges
+        ]
+        closing = ('\r\n--%s--\r\n' % (boundary)).encode('latin-1')
+
+        def parts():
+            for i, (start, stop) in enumerate(ranges):
+                # Заголовок части отделяется от предыдущей CRLF
+                yield (b'\r\n' if i else b'') + headers[i]
+                yield from read_range(path, start, stop)
+            yield closing
+
+        response = Response(
+            parts(),
+            status=206,
+            mimetype='multipart/byteranges; boundary=%s' % (boundary),
+            direct_passthrough=True
+        )
+        # Длина тела известна заранее, ответ не нужно буферизовать
+        response.content_length = sum(
+            len(h) + stop - start for h, (start, stop) in zip(headers, ranges)
+        ) + 2 * (len(ranges) - 1) + len(closing)
+    response.accept_ranges = 'bytes'
+    return response
+
+
+def save_with_hash(stream, path, chunk_size=1024 * 1024):
+    """
+    Save stream to file and compute its SHA-512 hash in one pass.
+
+    Parameters:
+    stream (File-like object) - Source data stream
+    path (String) - Path to target file
+    chunk_size (Integer number) - Size of read chunks in bytes
+    """
+    hash = hashlib.sha512()
+    with open(path, 'wb') as f:
+        for chunk in iter(lambda: stream.read(chunk_size), b''):
+            hash.update(chunk)
+            f.write(chunk)
+    return hash.hexdigest()
+
+
+def json_document(envelope, key, items):
+    """
+    Encode JSON document with list of items to bytes.
+
+    Envelope and list of items are encoded separately and joined as bytes,
+    so response dictionary is not rebuilt with whole list inside.
+
+    Parameters:
+    envelope (Dictionary) - other data of document
+    key (String) - key of items list in document
+    items (Iterable of dictionaries) - items of list
+    """
+    return b''.join(json_stream(envelope, key, items, chunked=False))
+
+
+def json_stream(envelope, key, items, ndjson=False, chunked=True):
+    """
+    Generate JSON document with list of items chunk by chunk (bytes).
+
+    In NDJSON mode every item is separate line and envelope is sent
+    as trailer line after all items.
+
+    Parameters:
+    envelope (Dictionary) - other data of document
+    key (String) - key of items list in document
+    items (Iterable of dictionaries) - items of list
+    ndjson (Boolean) - Generate newline delimited JSON
+    chunked (Boolean) - Yield every item separately (else all items are
+    encoded in one call and yielded as one fragment)
+    """
+    if ndjson:
+        for item in items:
+            yield json_dumps(item) + b'\n'
+        yield json_dumps(envelope) + b'\n'
+        return
+
+    # Конверт (родительская директория, пагинация) кодируется один раз
+    head = json_dumps(envelope)[:-1]
+    yield b'%s%s%s:[' % (head, b',' if envelope else b'', json_dumps(key))
+    if chunked:
+        separator = b''
+        for item in items:
+            yield separator + json_dumps(item)
+            separator = b','
+    else:
+        yield json_dumps(list(items))[1:-1]
+    yield b']}'
+
+
 def pagination_of_list(query_result, url, query_params):
     """
     Pagination of query results.
@@ -81,17 +520,36 @@ def pagination_of_list(query_result, url, query_params):
     url (String) - URL API for links generation
     query_params (Dictionary) - parameters, sended with query
     """
+    response_obj = pagination_data(len(query_result), url, query_params)
+    start = response_obj['start']
+    limit = response_obj['limit']
+
+    # Отсеивание результатов запроса
+    response_obj['results'] = query_result[(start - 1):(start - 1 + limit)]
+
+    return response_obj
+
+
+def pagination_data(records_count, url, query_params):
+    """
+    Pagination data (page bounds and links) without results slicing.
+
+    Parameters:
+    records_count (Integer number) - count of all records of query
+    url (String) - URL API for links generation
+    query_params (Dictionary) - parameters, sended with query
+    """
     start = query_params.get('start', 1)
     limit = query_params.get('limit', 10)
 
-    query_params_string = ''
-    for i in query_params:
-        if i not in ('start', 'limit'):
-            query_params_string += '&%s=%s' % (
-                i, query_params.get(i).replace(' ', '+')
-            )
-
-    records_count = len(query_result)
+    # Значения параметров кодируются (в «q» бывают кириллица и пробелы)
+    params = [
+        (k, v) for k, v in (
+            query_params.items(multi=True)
+            if hasattr(query_params, 'getlist') else query_params.items()
+        )
+        if k not in ('start', 'limit')
+    ]
 
     if not isinstance(start, int):
         try:
@@ -128,38 +586,373 @@ def pagination_of_list(query_result, url, query_params):
     else:
         start_copy = max(1, start - limit)
         limit_copy = start - 1
-        params = '?start=%d&limit=%d%s' % (
-            start_copy,
-            limit_copy,
-            query_params_string
-        )
-        new_url = urljoin(url,
-                          params)
-        response_obj['previousPage'] = new_url
+        response_obj['previousPage'] = '%s?%s' % (url, urlencode(
+            [('start', start_copy), ('limit', limit_copy)] + params
+        ))
 
     # Создаем URL на следующую страницу
     if start + limit > records_count:
         response_obj['nextPage'] = ''
     else:
         start_copy = start + limit
-        params = '?start=%d&limit=%d%s' % (
-            start_copy,
-            limit,
-            query_params_string
-        )
-        new_url = urljoin(url,
-                          params)
-        response_obj['nextPage'] = new_url
+        response_obj['nextPage'] = '%s?%s' % (url, urlencode(
+            [('start', start_copy), ('limit', limit)] + params
+        ))
+
+    return response_obj
 
-    # Отсеивание результатов запроса
-    response_obj['results'] = query_result[(start - 1):(start - 1 + limit)]
+
+def cursor_pagination_data(
+        items_count, limit, cursor, next_cursor, url, query_params
+):
+    """
+    Pagination data for cursor (keyset) pagination.
+
+    Parameters:
+    items_count (Integer number) - count of all records of query
+    limit (Integer number) - count of records on page
+    cursor (String) - cursor of current page
+    next_cursor (String) - cursor of next page (None if it is last page)
+    url (String) - URL API for links generation
+    query_params (Dictionary) - parameters, sended with query
+    """
+    response_obj = {}
+    response_obj['cursor'] = cursor
+    response_obj['limit'] = limit
+    response_obj['itemsCount'] = items_count
+
+    if next_cursor is None:
+        response_obj['nextCursor'] = ''
+        response_obj['nextPage'] = ''
+    else:
+        params = [
+            (k, v) for k, v in query_params.items(multi=True)
+            if k not in ('start', 'cursor')
+        ]
+        params.append(('cursor', next_cursor))
+        response_obj['nextCursor'] = next_cursor
+        response_obj['nextPage'] = '%s?%s' % (url, urlencode(params))
 
     return response_obj
 
 
+def encode_cursor(value):
+    """Encode JSON-serializable value to opaque cursor token."""
+    token = base64.urlsafe_b64encode(
+        json.dumps(value, separators=(',', ':')).encode('utf-8')
+    )
+    return token.decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """Decode cursor token, created by «encode_cursor»."""
+    token += '=' * (-len(token) % 4)
+    return json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+
+
+def query_limit(query_params, default=10):
+    """Get positive «limit» query parameter or default value."""
+    try:
+        limit = int(query_params.get('limit', default))
+    except ValueError:
+        return default
+    return limit if limit >= 1 else default
+
+
+def query_fields(query_params, fields):
+    """
+    Get metadata fields requested by «fields» query parameter.
+
+    Returns list of selected fields (all if parameter isn't given, «name»
+    if none of requested fields is supported) and description of parameter
+    for response (None if parameter isn't given). Unsupported fields are
+    not selected and are listed in description.
+
+    Parameters:
+    query_params (Dictionary) - Query parameters of request
+    fields (List of strings) - Supported fields in order of metadata
+    """
+    fields_query = query_params.get('fields', None)
+    if not fields_query:
+        return list(fields), None
+    fields_params_all = [k for k in re.split('[ ,]+', fields_query) if k]
+    fields_params = [k for k in fields if k in fields_params_all] or ['name']
+    fields_info = {'selectedFields': fields_params}
+    unsupported_f_params = [k for k in fields_params_all if k not in fields]
+    if unsupported_f_params:
+        fields_info['unsupportedFields'] = unsupported_f_params
+    return fields_params, fields_info
+
+
+def keyset_page(items, key, after=None, limit=10, reverse=False):
+    """
+    Get page of items following the cursor key in sorting order.
+
+    Key must define total order of items (end it by unique field).
+    Returns tuple of page items and flag of following items existence.
+
+    Parameters:
+    items (List) - sequence to paginate
+    key (Function) - sorting key
+    after (Tuple) - key of last item of previous page (None for first page)
+    limit (Integer number) - count of items on page
+    reverse (Boolean) - descending sorting order
+    """
+    if after is not None:
+        if reverse:
+            items = [i for i in items if key(i) < after]
+        else:
+            items = [i for i in items if key(i) > after]
+    page = sorted_head(items, key=key, reverse=reverse, count=limit + 1)
+    return page[:limit], len(page) > limit
+
+
+def sorted_head(items, key, reverse=False, count=None):
+    """
+    Get first «count» items of sorted sequence.
+
+    Uses heap selection instead of full sorting when only the beginning
+    of long sequence is needed. Result is the same as
+    «sorted(items, key=key, reverse=reverse)[:count]».
+
+    Parameters:
+    items (List) - sequence to sort
+    key (Function) - sorting key
+    reverse (Boolean) - sort in descending order
+    count (Integer number) - count of needed items (all if None)
+    """
+    if count is None or count * 4 >= len(items):
+        return sorted(items, key=key, reverse=reverse)[:count]
+    if reverse:
+        return heapq.nlargest(count, items, key=key)
+    return heapq.nsmallest(count, items, key=key)
+
+
+def supported_image_formats():
+    """Get output formats of derived images supported by Pillow."""
+    Image.init()
+    return [f for f in IMAGE_FORMATS if f in Image.SAVE]
+
+
+def negotiate_image_format(requested=None):
+    """
+    Choose output format of derived image.
+
+    Explicitly requested format has priority, else the first of
+    «IMAGE_NEGOTIATED_FORMATS» listed in «Accept» header is chosen.
+    Returns None if default format should be used. Raises ValueError
+    if requested format isn't supported.
+
+    Parameters:
+    requested (String) - Value of «format» query parameter
+    """
+    supported = supported_image_formats()
+    if requested:
+        image_format = requested.upper()
+        if image_format == 'JPG':
+            image_format = 'JPEG'
+        if image_format not in supported:
+            raise ValueError(requested)
+        return image_format
+    # Wildcards (e.g. «*/*») don't count, format must be listed explicitly
+    accepted = [m for m, q in request.accept_mimetypes if q > 0]
+    for image_format in app.config['IMAGE_NEGOTIATED_FORMATS']:
+        if image_format in supported and \
+                IMAGE_FORMATS[image_format][0] in accepted:
+            return image_format
+    return None
+
+
+def open_image(path, size=None, fit=False, reducing_gap=2):
+    """
+    Open and decode image, at reduced resolution if it is much larger.
+
+    JPEG images are decoded with DCT scaling, JPEG 2000 images at reduced
+    resolution level and TIFF images from the smallest suitable
+    reduced-resolution page (if file has them). Other images are decoded
+    whole, so image is not decoded if it has more than
+    «THUMBNAIL_MAX_DECODE_PIXELS» pixels (OSError is raised). Then image is
+    reduced by integer factor. Result is at least «reducing_gap» times
+    larger than needed size, so quality of following resampling doesn't
+    change.
+
+    Parameters:
+    path (String) - Path to image
+    size (Tuple of integer numbers) - Needed size (original size if None)
+    fit (Boolean) - Result will be cropped to fill whole size (else image
+    will be fitted inside size)
+    reducing_gap (Float number) - Minimal ratio of decoded and needed sizes
+    """
+    image = Image.open(path)
+    image_format = image.format
+    if size is None:
+        image.load()
+        return image
+
+    width, height = image.size
+    scales = (size[0] / width, size[1] / height)
+    scale = max(scales) if fit else min(scales)
+    needed = (
+        max(1, math.ceil(width * scale * reducing_gap)),
+        max(1, math.ceil(height * scale * reducing_gap))
+    )
+    decoded = None
+    if image_format == 'JPEG':
+        image.draft(image.mode, needed)
+    elif image_format == 'JPEG2000':
+        # Уровень разрешения: размер уменьшается в 2 ** reduce раз,
+        # число уровней в файле обычно не меньше 5
+        level = 0
+        while level < 5 and width >> (level + 1) >= needed[0] and \
+                height >> (level + 1) >= needed[1]:
+            level += 1
+        image.reduce = level
+        # Размер меняется только при декодировании
+        decoded = (
+            math.ceil(width / (1 << level)),
+            math.ceil(height / (1 << level))
+        )
+    elif image_format == 'TIFF' and getattr(image, 'n_frames', 1) > 1:
+        # Страницы уменьшенного разрешения помечены битом 0 тега
+        # NewSubfileType (254), другие страницы (листы документа) не подходят
+        best, best_size = 0, image.size
+        for frame in range(1, image.n_frames):
+            image.seek(frame)
+            if image.tag_v2.get(254, 0) & 1 and \
+                    needed[0] <= image.size[0] < best_size[0] and \
+                    needed[1] <= image.size[1] <= best_size[1]:
+                best, best_size = frame, image.size
+        image.seek(best)
+
+    decoded = decoded or image.size
+    if decoded[0] * decoded[1] > app.config['THUMBNAIL_MAX_DECODE_PIXELS']:
+        raise OSError('Image is too large for decoding: %sx%s' % (decoded))
+    image.load()
+
+    factor = min(image.size[0] // needed[0], image.size[1] // needed[1])
+    if factor >= 2:
+        # Метод вызывается через класс: у JPEG 2000 «reduce» - свойство
+        image = Image.Image.reduce(image, factor)
+        image.format = image_format
+    return image
+
+
+def load_watermark():
+    """
+    Load base watermark stamp in RGBA mode.
+
+    Try to open watermark file, if not - open font and draw phrase.
+    Returns None if neither file nor font can be opened.
+    """
+    try:
+        watermark = Image.open(app.config['WATERMARK_FILE'])
+        watermark.load()
+    except Exception:
+        watermark = Image.new("RGBA", (510, 45), (0, 0, 0, 0))
+        try:
+            font = ImageFont.truetype(app.config['WATERMARK_FONT'], 40)
+        except Exception:
+            return None
+        draw = ImageDraw.Draw(watermark)
+        phrase = "КОГБУ «ЦГАКО» ОБРАЗЕЦ"
+        draw.text((0, 0), phrase, font=font, fill=(0, 0, 0, 255))
+
+    # Check watermark image mode and convert to RGBA if needed
+    if watermark.mode != 'RGBA':
+        watermark = watermark.convert('RGBA')
+    return watermark
+
+
+watermark_stamp = load_watermark()
+
+
+# Подготовленные штампы: (прозрачность, ширина, угол) -> изображение
+watermark_cache = OrderedDict()
+watermark_cache_lock = threading.Lock()
+watermark_cache_size = 0
+
+
+def prepared_watermark(opacity, width, angle):
+    """
+    Get watermark stamp with changed opacity, resized and rotated.
+
+    Results are shared between requests and must not be changed. Least
+    recently used results are kept in memory while their total size
+    (4 bytes per pixel) is in «WATERMARK_CACHE_MAX_SIZE», larger stamps
+    are not cached.
+
+    Parameters:
+    opacity (Float number) - Degree of transparency (0 to 1)
+    width (Integer number) - Width of stamp before rotation
+    angle (Float number) - Degrees of stamp rotation
+    """
+    global watermark_cache_size
+    key = (opacity, width, angle)
+    with watermark_cache_lock:
+        watermark = watermark_cache.get(key)
+        if watermark is not None:
+            watermark_cache.move_to_end(key)
+            return watermark
+
+    watermark = watermark_stamp.copy()
+    if opacity < 1:
+        # Change opacity of watermark
+        alpha = watermark.split()[3]
+        alpha = ImageEnhance.Brightness(alpha).enhance(opacity)
+        watermark.putalpha(alpha)
+    hight = int(
+        round(
+            abs(width / watermark.size[0]) * watermark.size[1]
+        )
+    )
+
+    # Resize image to calculated size and rotate to given angle
+    watermark = watermark.resize((width, hight), Image.ANTIALIAS)
+    watermark = watermark.rotate(angle, expand=True)
+
+    size = watermark.size[0] * watermark.size[1] * 4
+    max_size = app.config['WATERMARK_CACHE_MAX_SIZE']
+    if size > max_size:
+        return watermark
+    with watermark_cache_lock:
+        if key not in watermark_cache:
+            while watermark_cache and watermark_cache_size + size > max_size:
+                old_key, old_watermark = watermark_cache.popitem(last=False)
+                watermark_cache_size -= \
+                    old_watermark.size[0] * old_watermark.size[1] * 4
+            watermark_cache[key] = watermark
+            watermark_cache_size += size
+    return watermark
+
+
+def watermark_row(width, watermark, interval, shift=False):
+    """
+    Make transparent layer with one row of watermark stamps.
+
+    Stamps of rows don't overlap (interval is not negative), so pasting
+    the row layer is the same as pasting each stamp of row.
+
+    Parameters:
+    width (Integer number) - Width of row (width of image)
+    watermark (Image) - Watermark stamp
+    interval (Integer number) - Interval between stamps
+    shift (Boolean) - Shift by half of the stamp (for even rows)
+    """
+    row = Image.new('RGBA', (width, watermark.size[1]), (0, 0, 0, 0))
+    for x in range(
+        watermark.size[0]*-1,
+        width,
+        watermark.size[0]+interval
+    ):
+        if shift:
+            x += watermark.size[0]*0.5
+        row.paste(watermark, (int(x), 0))
+    return row
+
+
 def add_watermark(
         path, wm_opacity=0.5, wm_interval=None, wm_size=1.0, wm_angle=45.0,
-        wm_x=None, wm_y=None
+        wm_x=None, wm_y=None, image_format='JPEG', quality=None
 ):
     """
     Adding watermark to image.
@@ -172,6 +965,8 @@ def add_watermark(
     wm_angle (Float number) - Degrees of image rotation
     wm_x (Integer number) - x coordinate of image left upper point
     wm_y (Integer number) - y coordinate of image left upper point
+    image_format (String) - Output image format
+    quality (Integer number) - Output image quality (format default if None)
     """
     # Parameters checkings
     try:
@@ -260,47 +1055,47 @@ def add_watermark(
             'integer number value)!'
         ))
 
-    # Try to open watermark file, if not - open font and draw phrase
-    try:
-        watermark = Image.open(app.config['WATERMARK_FILE'])
-    except Exception:
-        watermark = Image.new("RGBA", (510, 45), (0, 0, 0, 0))
-        try:
-            font = ImageFont.truetype(app.config['WATERMARK_FONT'], 40)
-        except Exception:
-            raise Exception(json_http_response(
-                status=400,
-                given_message='Cannot draw watermark! Check watermark file in'
-                ' "%s" or font file in "%s"' % (
-                    app.config['WATERMARK_FILE'],
-                    app.config['WATERMARK_FONT']
-                ),
-                dbg=request.args.get('dbg', False)
-            ))
-        draw = ImageDraw.Draw(watermark)
-        phrase = "КОГБУ «ЦГАКО» ОБРАЗЕЦ"
-        draw.text((0, 0), phrase, font=font, fill=(0, 0, 0, 255))
+    # Base watermark stamp is loaded once on application start
+    if watermark_stamp is None:
+        raise Exception(json_http_response(
+            status=400,
+            given_message='Cannot draw watermark! Check watermark file in'
+            ' "%s" or font file in "%s"' % (
+                app.config.get('WATERMARK_FILE'),
+                app.config.get('WATERMARK_FONT')
+            ),
+            dbg=request.args.get('dbg', False)
+        ))
 
     # Open image by sended path parameter
-    image = Image.open(path, "r")
+    try:
+        image = Image.open(path, "r")
+    except OSError:
+        raise Exception(json_http_response(
+            status=400,
+            given_message='Watermark can`t be drawn on this file (it is not '
+            'an image)!',
+            dbg=request.args.get('dbg', False)
+        ))
+    # Изображение декодируется целиком, поэтому его размер ограничен так же,
+    # как для миниатюр
+    if image.size[0] * image.size[1] > \
+            app.config['THUMBNAIL_MAX_DECODE_PIXELS']:
+        raise Exception(json_http_response(
+            status=400,
+            given_message='Watermark can`t be drawn on this image (it is too '
+            'large)!',
+            dbg=request.args.get('dbg', False)
+        ))
 
-    # Check watermark image mode and convert to RGBA if needed
-    if watermark.mode != 'RGBA':
-        watermark = watermark.convert('RGBA')
-    else:
-        watermark = watermark.copy()
     # Check sended opacity parameter
     assert wm_opacity >= 0 and wm_opacity <= 1
-    if wm_opacity < 1:
-        # Change opacity of watermark
-        alpha = watermark.split()[3]
-        alpha = ImageEnhance.Brightness(alpha).enhance(wm_opacity)
-        watermark.putalpha(alpha)
     # Calculate new size according to original size and sended scaling
     new_width = int(image.size[0]*wm_size)
     new_hight = int(
         round(
-            abs(new_width / watermark.size[0]) * watermark.size[1]
+            abs(new_width / watermark_stamp.size[0]) *
+            watermark_stamp.size[1]
         )
     )
     if new_width <= 0 or new_hight <= 0:
@@ -310,32 +1105,26 @@ def add_watermark(
             dbg=request.args.get('dbg', False)
         ))
 
-    # Resize image to calculated size and rotate to given angle
-    watermark = watermark.resize((new_width, new_hight), Image.ANTIALIAS)
-    watermark = watermark.rotate(wm_angle, expand=True)
+    # Get watermark with given opacity, size and angle (memoized)
+    watermark = prepared_watermark(wm_opacity, new_width, wm_angle)
 
     # Create new empty layer with size of original image
     layer = Image.new('RGBA', image.size, (0, 0, 0, 0))
 
     # Stamping by all image surface if interval parameter sended
     if wm_interval is not None:
-        row = 1
-        for y in range(
+        # Odd and even rows are stamped once and pasted as whole rows
+        rows = (
+            watermark_row(image.size[0], watermark, wm_interval),
+            watermark_row(image.size[0], watermark, wm_interval, shift=True)
+        )
+        for row, y in enumerate(range(
             watermark.size[1]*-1,  # Start point with shift by one image left
             image.size[1]+watermark.size[1],  # End point with shift
             # by one image right
             watermark.size[1]+wm_interval  # Step size
-        ):
-            for x in range(
-                watermark.size[0]*-1,
-                image.size[0],
-                watermark.size[0]+wm_interval
-            ):
-                if row % 2 == 0:
-                    # Shift by half of the image in every even line
-                    x += watermark.size[0]*0.5
-                layer.paste(watermark, (int(x), int(y)))
-            row += 1
+        )):
+            layer.paste(rows[row % 2], (0, y))
     # Else make single watermark stamp
     else:
         # On point according to x and y sended parameters
@@ -361,8 +1150,13 @@ def add_watermark(
     data = io.BytesIO()
     # Join image and watermark
     n_image = Image.composite(layer,  image,  layer)
+    if image_format == 'JPEG' and n_image.mode not in ('RGB', 'L', 'CMYK'):
+        n_image = n_image.convert('RGB')
     # Save image to buffer instead of file in filesystem
-    n_image.save(data, "JPEG")
+    if quality is not None:
+        n_image.save(data, image_format, quality=quality)
+    else:
+        n_image.save(data, image_format)
     # Move to begin of buffer
     data.seek(0)
     return data
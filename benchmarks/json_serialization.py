@@ -0,0 +1,84 @@
+"""
+Benchmark of files list serialization.
+
+Compares former encoding of listing response (whole document through
+Flask «json.dumps» to text) with «json_document» for every installed JSON
+library. Metadata dictionaries are prepared before measurement, so only
+serialization is timed. Run from project root with configured
+«config.py»: python -m benchmarks.json_serialization
+"""
+
+import os
+import tempfile
+import timeit
+
+from flask import json, url_for
+
+from app import app, utils
+from app.classes import FileSystemObject
+from app.utils import json_backend, json_document, pagination_data
+
+COUNT = 1000
+REPEAT = 100
+
+
+def legacy(response_obj, files_metadata):
+    """Encode listing like «get_file» did."""
+    response_obj = dict(response_obj, filesList=list(files_metadata))
+    return json.dumps(response_obj, ensure_ascii=False).encode('utf-8')
+
+
+def main():
+    """Print average serialization time per 1000 listing entries."""
+    with tempfile.TemporaryDirectory(dir=app.config['ROOT_PATH']) \
+            as directory:
+        for i in range(COUNT):
+            name = 'файл_%05d.txt' % (i)
+            with open(os.path.join(directory, name), 'w') as f:
+                f.write('x' * (i % 1000))
+        asked_file_path = os.path.relpath(directory, app.config['ROOT_PATH'])
+        with app.test_request_context():
+            # Ответ собирается так же, как в «get_file»
+            fields_params = list(FileSystemObject.fields)
+            with os.scandir(directory) as entries:
+                files_metadata = [
+                    FileSystemObject(entry.path, entry=entry).prefetch(
+                        fields_params
+                    ).get_metadata(fields_params)
+                    for entry in entries
+                ]
+            response_obj = {
+                'parentDirectory': url_for('.get_file', _external=True),
+                'paginationData': pagination_data(
+                    COUNT,
+                    url_for(
+                        '.get_file',
+                        asked_file_path=asked_file_path,
+                        _external=True
+                    ),
+                    query_params={'limit': str(COUNT)}
+                )
+            }
+            seconds = timeit.timeit(
+                lambda: legacy(response_obj, files_metadata),
+                number=REPEAT
+            )
+            print('%-8s %8.2f ms' % ('legacy', seconds / REPEAT * 1e3))
+            for name in ('json', 'ujson', 'orjson'):
+                try:
+                    utils.json_dumps = json_backend(name)
+                except ImportError:
+                    continue
+                seconds = timeit.timeit(
+                    lambda: json_document(
+                        response_obj,
+                        'filesList',
+                        files_metadata
+                    ),
+                    number=REPEAT
+                )
+                print('%-8s %8.2f ms' % (name, seconds / REPEAT * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+"""
+Benchmark of memory used by files list objects.
+
+Creates directory with many files and builds list of objects like
+«get_file» does (scandir, then fields of default sorting and of page
+metadata), then serializes all of them. Compares former dictionary based
+object (cached properties, kept «DirEntry» and «stat_result») with
+slotted «FileSystemObject». Prints allocated memory per entry
+(tracemalloc) and peak RSS of process. Run from project root with
+configured «config.py»: python -m benchmarks.listing_memory [COUNT]
+"""
+
+import gc
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from datetime import datetime
+from functools import cached_property
+
+from app import app
+from app.classes import FileSystemObject, directory_sizes
+
+
+class LegacyFileSystemObject:
+    """Former files list object (only fields used by benchmark)."""
+
+    fields = FileSystemObject.fields
+
+    def __init__(self, path, entry=None):
+        """Class description."""
+        self.path = path
+        self.entry = entry
+
+    @cached_property
+    def stat(self):
+        """Stat of object, shared by all attributes."""
+        if self.entry is not None:
+            return self.entry.stat()
+        return os.stat(self.path)
+
+    @cached_property
+    def is_directory(self):
+        """Object is directory."""
+        if self.entry is not None:
+            return self.entry.is_dir()
+        return os.path.isdir(self.path)
+
+    @cached_property
+    def name(self):
+        """Name of object."""
+        if self.entry is not None:
+            return self.entry.name
+        return self.path.rsplit('/', maxsplit=1)[-1]
+
+    @cached_property
+    def sizeBytes(self):
+        """Size of file or total size of directory in bytes."""
+        return directory_sizes.get(self.path) \
+            if self.is_directory else self.stat.st_size
+
+    @cached_property
+    def sizeFormatted(self):
+        """Size with auto detected measure unit."""
+        return FileSystemObject.get_file_size(None, self.sizeBytes)
+
+    @cached_property
+    def created(self):
+        """Creation (metadata change) datetime string."""
+        return str(datetime.fromtimestamp(int(self.stat.st_ctime)))
+
+    @cached_property
+    def modified(self):
+        """Modification datetime string."""
+        return str(datetime.fromtimestamp(int(self.stat.st_mtime)))
+
+    def prefetch(self, fields):
+        """Compute metadata fields without building dictionary."""
+        for field in fields:
+            if field in ('sizeNumber', 'sizeSuffix'):
+                self.sizeFormatted
+            else:
+                getattr(self, field)
+        return self
+
+    def get_metadata(self, fields):
+        """Get class data in json dictionary."""
+        returned_dict = {}
+        for field in fields:
+            if field == 'sizeNumber':
+                returned_dict[field] = self.sizeFormatted['number']
+            elif field == 'sizeSuffix':
+                returned_dict[field] = self.sizeFormatted['suffix']
+            else:
+                returned_dict[field] = getattr(self, field)
+        return returned_dict
+
+
+def build(cls, directory, fields):
+    """List directory like «get_file» and serialize all entries."""
+    with os.scandir(directory) as entries:
+        files = [
+            cls(entry.path, entry=entry).prefetch(fields)
+            for entry in entries
+        ]
+    with app.test_request_context():
+        metadata = [f.get_metadata(fields) for f in files]
+    return files, metadata
+
+
+def measure(cls, directory, fields, count):
+    """Print memory per listed entry and time of listing for class."""
+    gc.collect()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    files, metadata = build(cls, directory, fields)
+    elapsed = time.perf_counter() - started
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    del files, metadata
+    gc.collect()
+
+    # Повторный проход под tracemalloc: объекты отдельно от словарей
+    tracemalloc.start()
+    files, metadata = build(cls, directory, fields)
+    _, peak = tracemalloc.get_traced_memory()
+    del metadata
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del files
+    gc.collect()
+
+    print(cls.__name__)
+    print('  objects, per entry:  %d B' % (current / count))
+    print('  peak, per entry:     %d B' % (peak / count))
+    print('  peak RSS, per entry: %d B' % (
+        (rss_after - rss_before) * 1024 / count
+    ))
+    print('  time:                %.2f s' % (elapsed))
+
+
+def main():
+    """Print memory per listed entry for former and slotted objects."""
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    fields = ['name', 'path', 'sizeBytes', 'sizeNumber', 'sizeSuffix',
+              'created', 'modified']
+    with tempfile.TemporaryDirectory() as directory:
+        for i in range(count):
+            open(os.path.join(directory, 'file_%06d.txt' % (i)), 'w').close()
+        print('entries: %d' % (count))
+        # Пиковый RSS процесса только растет, поэтому каждый вариант
+        # измеряется в отдельном дочернем процессе
+        context = multiprocessing.get_context('fork')
+        for cls in (LegacyFileSystemObject, FileSystemObject):
+            process = context.Process(
+                target=measure,
+                args=(cls, directory, fields, count)
+            )
+            process.start()
+            process.join()
+
+
+if __name__ == '__main__':
+    main()
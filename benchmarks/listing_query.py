@@ -0,0 +1,88 @@
+"""
+Benchmark of files list search and sorting.
+
+Compares former path of «get_file» (metadata dictionary built for every
+object, substring tests, «attrgetter» sorting) with compiled
+«ListingQuery» over rows. Objects are prefetched before measurement, so
+only filtering and sorting are timed. Run from project root with
+configured «config.py»: python -m benchmarks.listing_query
+"""
+
+import os
+import tempfile
+import timeit
+
+from operator import attrgetter
+
+from app import app
+from app.classes import FileSystemObject, ListingQuery
+from app.utils import sorted_head
+
+COUNT = 20000
+PAGE = 10
+REPEAT = 10
+CASES = (
+    ({'name': '7'}, ['name']),
+    ({'name': '7', 'type': 'text/'}, ['modified', 'name']),
+    ({'name': '7'}, ['sizeBytes', 'name']),
+)
+
+
+def legacy(files, search_params, sorting_params):
+    """Filter and sort objects like «get_file» did."""
+    files = [
+        f for f in files if all(
+            True if val in f.get_metadata(search_params).get(key, None)
+            else False
+            for key, val in search_params.items()
+        )
+    ]
+    return sorted_head(files, key=attrgetter(*sorting_params), count=PAGE)
+
+
+def compiled(files, search_params, sorting_params):
+    """Filter and sort objects with compiled query."""
+    query = ListingQuery(search_params, sorting_params)
+    rows = [r for r in map(query.row, files) if query.matches(r)]
+    return [
+        r[-1] for r in sorted_head(rows, key=query.sort_key, count=PAGE)
+    ]
+
+
+def main():
+    """Print average time of filtering and sorting for each case."""
+    with tempfile.TemporaryDirectory() as directory:
+        for i in range(COUNT):
+            with open(os.path.join(directory, 'file_%05d.txt' % (i)), 'w') \
+                    as f:
+                f.write('x' * (i % 1000))
+        with os.scandir(directory) as entries:
+            files = [
+                FileSystemObject(entry.path, entry=entry).prefetch(
+                    ['name', 'type', 'sizeBytes', 'modified']
+                )
+                for entry in entries
+            ]
+        with app.test_request_context():
+            for search_params, sorting_params in CASES:
+                print('q=%s sf=%s' % (search_params, sorting_params))
+                for name, function in (
+                    ('legacy', legacy),
+                    ('compiled', compiled)
+                ):
+                    seconds = timeit.timeit(
+                        lambda: function(
+                            files,
+                            search_params,
+                            sorting_params
+                        ),
+                        number=REPEAT
+                    )
+                    print('  %-8s %8.2f ms' % (
+                        name,
+                        seconds / REPEAT * 1e3
+                    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+Benchmark of tail-of-file «Range» requests.
+
+Creates sparse files of different sizes and measures latency of reading
+last 64 KiB of each of them (single range and multi-range requests).
+Latency should not depend on file size. Run from project root with
+configured «config.py»: python -m benchmarks.range_seek
+"""
+
+import os
+import tempfile
+import timeit
+
+from app import app
+from app.utils import range_response
+
+SIZES = (1024 ** 2, 100 * 1024 ** 2, 1024 ** 3, 10 * 1024 ** 3)
+RANGES = (
+    ('tail', 'bytes=-65536'),
+    ('multi', 'bytes=0-4095,-65536'),
+)
+REPEAT = 200
+
+
+def request_range(path, range_header):
+    """Make range response for file and read its body."""
+    with app.test_request_context(headers={'Range': range_header}):
+        response = range_response(path, 'application/octet-stream', 'etag')
+        for chunk in response.response:
+            pass
+
+
+def main():
+    """Print average latency of range requests for each file size."""
+    with tempfile.TemporaryDirectory() as directory:
+        for size in SIZES:
+            path = os.path.join(directory, '%s.bin' % (size))
+            with open(path, 'wb') as f:
+                # Разреженный файл, место на диске не занимается
+                f.truncate(size)
+                f.seek(size - 65536)
+                f.write(os.urandom(65536))
+            for name, range_header in RANGES:
+                seconds = timeit.timeit(
+                    lambda: request_range(path, range_header),
+                    number=REPEAT
+                )
+                print('%6s %8.0f MiB %8.1f us' % (
+                    name,
+                    size / 1024 ** 2,
+                    seconds / REPEAT * 1e6
+                ))
+
+
+if __name__ == '__main__':
+    main()
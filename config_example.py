@@ -15,3 +15,73 @@ THUMBNAIL_MEDIA_URL = '/files/'
 THUMBNAIL_MEDIA_THUMBNAIL_URL = '/files/.thumbnails/'
 
 THUMBNAIL_DEFAUL_FORMAT = 'JPEG'
+
+# Служебная папка для индексов метаданных (хэши, MIME-типы, размеры)
+INDEX_FOLDER = '.index'
+METADATA_INDEX_FILE = os.path.join(ROOT_PATH, INDEX_FOLDER, 'metadata.sqlite3')
+# Время жизни (в секундах) закэшированных размеров директорий,
+# None - хранить до изменения через API
+DIRECTORY_SIZE_TTL = 300
+# Количество директорий, отсортированные списки которых хранятся в памяти
+# (используются для постраничного вывода по курсору)
+LISTING_INDEX_SIZE = 128
+# Потоки для параллельного вычисления метаданных (хэши, MIME-типы, размеры):
+# всего в процессе и максимум на один запрос (1 - без параллельности).
+# Лимит на запрос меньше пула, чтобы один большой листинг не занимал все
+# потоки (по умолчанию половина METADATA_WORKERS, но не меньше 1)
+METADATA_WORKERS = 4
+METADATA_REQUEST_WORKERS = max(1, METADATA_WORKERS // 2)
+# Кэш изображений с водяными знаками (максимальный размер в байтах)
+RENDER_CACHE_FOLDER = '.renders'
+RENDER_CACHE_ROOT = os.path.join(ROOT_PATH, RENDER_CACHE_FOLDER)
+RENDER_CACHE_MAX_SIZE = 1024 * 1024 * 1024
+# Память под подготовленные (масштабированные и повернутые) водяные знаки
+# в каждом процессе (в байтах), больший штамп не кэшируется
+WATERMARK_CACHE_MAX_SIZE = 64 * 1024 * 1024
+# Размеры миниатюр, создаваемых в фоне после загрузки изображений
+# («SIZE» или «SIZE:fit»/«SIZE:sized»; в формате по умолчанию и в каждом
+# поддерживаемом формате из IMAGE_NEGOTIATED_FORMATS), и количество потоков
+# очереди
+THUMBNAIL_PRESETS = ['200x200', '800x800']
+THUMBNAIL_QUEUE_FILE = os.path.join(
+    ROOT_PATH, INDEX_FOLDER, 'thumbnails.sqlite3'
+)
+THUMBNAIL_QUEUE_WORKERS = 2
+# Максимум пикселей, декодируемых для миниатюры (около 4 байт памяти на
+# пиксель). JPEG, JPEG 2000 и TIFF со страницами уменьшенного разрешения
+# декодируются уменьшенными, остальные изображения больше предела
+# не получают миниатюр
+THUMBNAIL_MAX_DECODE_PIXELS = 32 * 1000 * 1000
+# Файлы блокировок, через которые процессы договариваются, кто создает
+# миниатюру или изображение с водяным знаком
+LOCKS_ROOT = os.path.join(ROOT_PATH, INDEX_FOLDER, 'locks')
+THUMBNAIL_STORAGE_BACKEND = 'app.classes.AtomicFilesystemStorageBackend'
+# Форматы миниатюр и изображений с водяными знаками, выбираемые по заголовку
+# Accept (в порядке предпочтения, если поддерживаются Pillow)
+IMAGE_NEGOTIATED_FORMATS = ['AVIF', 'WEBP']
+# Сессии загрузки файлов по частям: база сессий, папка с недогруженными
+# файлами (лучше на той же файловой системе, что и ROOT_PATH) и время жизни
+UPLOADS_INDEX_FILE = os.path.join(ROOT_PATH, INDEX_FOLDER, 'uploads.sqlite3')
+UPLOADS_ROOT = os.path.join(ROOT_PATH, INDEX_FOLDER, 'uploads')
+UPLOAD_SESSION_TTL = 24 * 60 * 60
+# Способ отдачи файлов: «wsgi» (через wsgi.file_wrapper сервера),
+# «x-sendfile» (Apache/lighttpd) или «x-accel-redirect» (nginx, нужна
+# internal location FILE_DELIVERY_ACCEL_ROOT с alias на ROOT_PATH)
+FILE_DELIVERY_BACKEND = 'wsgi'
+FILE_DELIVERY_ACCEL_ROOT = '/protected/'
+# Максимум диапазонов в одном запросе с заголовком Range (при большем
+# количестве файл отдается целиком)
+MAX_BYTE_RANGES = 16
+# Максимум путей в одном запросе POST /files/_batch/metadata
+BATCH_METADATA_MAX_PATHS = 10000
+# Отслеживание изменений в ROOT_PATH в обход API (сканеры, rsync) для сброса
+# кэшей: None - выключено, «inotify», «polling» (сравнение снимков дерева
+# каждые FILESYSTEM_WATCHER_INTERVAL секунд) или «auto». Дерево отслеживает
+# один процесс (блокировка в LOCKS_ROOT), остальные ждут ее освобождения
+FILESYSTEM_WATCHER = None
+FILESYSTEM_WATCHER_INTERVAL = 5
+# Индекс поиска по всему дереву (GET /search)
+SEARCH_INDEX_FILE = os.path.join(ROOT_PATH, INDEX_FOLDER, 'search.sqlite3')
+# Библиотека для кодирования ответов в JSON: «auto» (orjson или ujson, если
+# установлены, иначе стандартная), «orjson», «ujson» или «json»
+JSON_BACKEND = 'auto'
@@ -0,0 +1,48 @@
+"""Test configuration: application with temporary root directory."""
+
+import os
+import shutil
+import sys
+import tempfile
+import types
+
+import pytest
+
+# Приложение читает модуль «config» при импорте, поэтому он подменяется
+# до импорта «app»
+ROOT_PATH = tempfile.mkdtemp(prefix='cdnapi-tests-')
+config = types.ModuleType('config')
+config.ROOT_PATH = ROOT_PATH
+config.THUMBNAILS_FOLDER = '.thumbnails'
+config.THUMBNAIL_MEDIA_ROOT = ROOT_PATH
+config.THUMBNAIL_MEDIA_THUMBNAIL_ROOT = os.path.join(ROOT_PATH, '.thumbnails')
+config.THUMBNAIL_MEDIA_URL = '/files/'
+config.THUMBNAIL_MEDIA_THUMBNAIL_URL = '/files/.thumbnails/'
+config.WATERMARK_FILE = os.path.join(ROOT_PATH, 'nonexistent.png')
+config.WATERMARK_FONT = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'font.ttf'
+)
+config.SERVER_NAME = 'localhost'
+sys.modules['config'] = config
+
+from app import app  # noqa
+
+
+@pytest.fixture
+def root():
+    """Empty root directory of files."""
+    yield ROOT_PATH
+    for name in os.listdir(ROOT_PATH):
+        if not name.startswith('.'):
+            path = os.path.join(ROOT_PATH, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+
+@pytest.fixture
+def client(root):
+    """Test client of application."""
+    return app.test_client()
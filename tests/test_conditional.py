@@ -0,0 +1,21 @@
+"""Tests of conditional and range requests of files."""
+
+import os
+
+
+def test_file_etag_is_stable_after_hashing(client, root):
+    """Hashing file in listing doesn't change its ETag."""
+    with open(os.path.join(root, 'scan.bin'), 'wb') as f:
+        f.write(bytes(range(256)) * 4)
+    etag = client.get('/files/scan.bin').headers['ETag']
+
+    assert client.get('/files?fields=name,hash').status_code == 200
+
+    response = client.get('/files/scan.bin', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    response = client.get(
+        '/files/scan.bin',
+        headers={'Range': 'bytes=0-9', 'If-Range': etag}
+    )
+    assert response.status_code == 206
+    assert response.data == bytes(range(10))
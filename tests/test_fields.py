@@ -0,0 +1,34 @@
+"""Tests of «fields» parameter of metadata responses."""
+
+import os
+
+from app import search_index
+
+
+def test_unknown_fields_are_reported_everywhere(client, root):
+    """Listing, batch metadata and search select fields the same way."""
+    with open(os.path.join(root, 'report.txt'), 'w') as f:
+        f.write('report')
+    search_index.build()
+    if search_index._builder is not None:
+        search_index._builder.join()
+    search_index.add(os.path.join(root, 'report.txt'))
+
+    responses = [
+        client.get('/files?fields=name,size,sizeBytes'),
+        client.post(
+            '/files/_batch/metadata?fields=name,size,sizeBytes',
+            json={'paths': ['report.txt']}
+        ),
+        client.get('/search?q=report&fields=name,size,sizeBytes')
+    ]
+
+    for response in responses:
+        assert response.status_code == 200
+        assert response.json['fieldsParams'] == {
+            'selectedFields': ['name', 'sizeBytes'],
+            'unsupportedFields': ['size']
+        }
+        assert response.json['filesList'] == [
+            {'name': 'report.txt', 'sizeBytes': 6}
+        ]
@@ -0,0 +1,34 @@
+"""Tests of pagination data of files list."""
+
+import os
+
+from werkzeug.datastructures import MultiDict
+
+from app.utils import pagination_data
+
+
+def test_pagination_links_encode_query(client):
+    """Page links carry percent-encoded query parameters."""
+    data = pagination_data(
+        30,
+        'http://localhost/files',
+        MultiDict([('q', 'name:дело type:text'), ('limit', '10')])
+    )
+    assert data['nextPage'] == 'http://localhost/files?start=11&limit=10' \
+        '&q=name%3A%D0%B4%D0%B5%D0%BB%D0%BE+type%3Atext'
+    assert data['previousPage'] == ''
+
+
+def test_stream_pagination_header_with_non_ascii_query(client, root):
+    """Header of streamed list is sendable for non-ASCII search."""
+    for i in range(15):
+        open(os.path.join(root, 'дело_%02d.txt' % (i)), 'w').close()
+
+    response = client.get('/files?q=name:дело&stream=true&limit=10')
+
+    assert response.status_code == 200
+    header = response.headers['X-Pagination-Data']
+    # Сервер отправляет заголовки в latin-1
+    header.encode('latin-1')
+    assert '%D0%B4%D0%B5%D0%BB%D0%BE' in header
+    assert len(response.get_json()['filesList']) == 10
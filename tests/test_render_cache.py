@@ -0,0 +1,27 @@
+"""Tests of disk cache of rendered images."""
+
+import os
+
+from app.classes import RenderCache
+
+
+def test_size_is_kept_incrementally(root, tmp_path):
+    """Putting and discarding renders don't force walk of whole cache."""
+    cache = RenderCache(str(tmp_path), max_size=1024)
+    sources = []
+    for name in ('a.jpg', 'b.jpg'):
+        sources.append(os.path.join(root, name))
+        with open(sources[-1], 'wb') as f:
+            f.write(b'source')
+    cache.evict()
+    assert cache._size == 0
+
+    cache.put(sources[0], ('watermark',), b'x' * 100)
+    cache.put(sources[1], ('watermark',), b'x' * 30)
+    cache.put(sources[1], ('watermark',), b'x' * 50)
+    assert cache._size == 150
+
+    cache.discard(sources[0])
+    assert cache._size == 50
+    assert not os.path.exists(cache.directory(sources[0]))
+    assert cache.get(sources[1], ('watermark',)) is not None
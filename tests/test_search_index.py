@@ -0,0 +1,34 @@
+"""Tests of search index of files tree."""
+
+import io
+import os
+
+from app import search_index
+from app.classes import FileSystemObject
+
+PNG = b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01' \
+    b'\x08\x02\x00\x00\x00\x90wS\xde'
+
+
+def test_type_is_detected_by_content(client, root):
+    """Index and listings detect type of file the same way."""
+    path = os.path.join(root, 'scan.txt')
+    with open(path, 'wb') as f:
+        f.write(PNG)
+
+    record = search_index.record(path, os.stat(path))
+
+    assert record[3] == FileSystemObject(path).type == 'image/png'
+
+
+def test_uploaded_and_crawled_types_are_equal(client, root):
+    """Uploaded file gets the same type as file found by crawling."""
+    response = client.post(
+        '/files?names=upload',
+        data={'uploads': (io.BytesIO(PNG), 'upload.dat')}
+    )
+    assert response.status_code == 200
+    path = os.path.join(root, 'upload.dat')
+    uploaded = response.json['uploadedFiles'][0]['type']
+
+    assert search_index.record(path, os.stat(path))[3] == uploaded
@@ -0,0 +1,50 @@
+"""Tests of service directories protection."""
+
+import os
+
+from app import app
+
+
+def test_service_directories_are_not_listed(client, root):
+    """Indexes, caches and thumbnails are hidden in root listing."""
+    os.makedirs(os.path.join(root, 'docs'), exist_ok=True)
+    for path in (
+        os.path.join(root, app.config['INDEX_FOLDER']),
+        app.config['RENDER_CACHE_ROOT'],
+        app.config['THUMBNAIL_MEDIA_THUMBNAIL_ROOT']
+    ):
+        os.makedirs(path, exist_ok=True)
+
+    names = [
+        f['name'] for f in client.get('/files?limit=100').json['filesList']
+    ]
+    assert names == ['docs']
+
+    cursor_names = [
+        f['name']
+        for f in client.get('/files?cursor=&limit=100').json['filesList']
+    ]
+    assert cursor_names == ['docs']
+
+
+def test_service_directories_cannot_be_changed(client, root):
+    """Deleting, renaming and uploading into service directories fail."""
+    index_folder = app.config['INDEX_FOLDER']
+    os.makedirs(os.path.join(root, index_folder), exist_ok=True)
+    os.makedirs(os.path.join(root, 'docs'), exist_ok=True)
+
+    assert client.delete(
+        '/files/%s?recursive=true' % (index_folder)
+    ).status_code == 403
+    assert client.put(
+        '/files/%s?rename=index' % (index_folder)
+    ).status_code == 403
+    assert client.put(
+        '/files/docs?rename=%s' % (index_folder)
+    ).status_code == 403
+    assert client.post('/files/%s/x' % (index_folder)).status_code == 403
+    assert client.post(
+        '/uploads?path=%s&name=a.txt&size=1' % (index_folder)
+    ).status_code == 403
+    assert os.path.isdir(os.path.join(root, index_folder))
+    assert os.path.isdir(os.path.join(root, 'docs'))
@@ -0,0 +1,62 @@
+"""Tests of resumable uploads."""
+
+import io
+import os
+
+
+def create_upload(client):
+    """Create upload session of 10 bytes file and get its link."""
+    response = client.post('/uploads?path=&name=a.txt&size=10')
+    assert response.status_code == 201
+    return response.json['link'].replace('http://localhost', '')
+
+
+def test_out_of_order_chunk_without_accepted_bytes(client, root):
+    """Conflict without accepted bytes has no empty «Range» header."""
+    link = create_upload(client)
+    response = client.put(
+        link,
+        data=b'fghij',
+        headers={'Content-Range': 'bytes 5-9/10'}
+    )
+    assert response.status_code == 409
+    assert 'Range' not in response.headers
+
+    client.put(link, data=b'abc', headers={'Content-Range': 'bytes 0-2/10'})
+    response = client.put(
+        link,
+        data=b'fghij',
+        headers={'Content-Range': 'bytes 5-9/10'}
+    )
+    assert response.status_code == 409
+    assert response.headers['Range'] == 'bytes=0-2'
+
+
+def test_delete_upload_without_part_file(client, root):
+    """Session with removed part file is cancelled without error."""
+    link = create_upload(client)
+    client.put(link, data=b'abc', headers={'Content-Range': 'bytes 0-2/10'})
+    upload_id = link.rsplit('/', 1)[1]
+    for directory, _, files in os.walk(root):
+        for name in files:
+            if name.startswith(upload_id) and name.endswith('.part'):
+                os.remove(os.path.join(directory, name))
+
+    assert client.delete(link).status_code == 200
+    assert client.get(link).status_code == 404
+
+
+def test_overwrite_invalidates_thumbnails(client, root):
+    """Overwritten file doesn't keep thumbnails of former content."""
+    thumbnail_path = os.path.join(root, '.thumbnails', 'pic_200x200_90.png')
+    os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
+    with open(thumbnail_path, 'wb') as f:
+        f.write(b'old thumbnail')
+    os.utime(thumbnail_path, (0, 0))
+
+    response = client.post(
+        '/files?names=pic',
+        data={'uploads': (io.BytesIO(b'new content'), 'scan.png')}
+    )
+    assert response.status_code == 200
+    assert not os.path.exists(thumbnail_path)
@@ -0,0 +1,31 @@
+"""Tests of images with watermarks."""
+
+import os
+
+from PIL import Image
+
+from app import app, utils
+
+
+def test_watermark_limits_decoded_pixels(client, root, monkeypatch):
+    """Too large or broken originals get 400 instead of full decoding."""
+    monkeypatch.setattr(
+        utils,
+        'watermark_stamp',
+        Image.new('RGBA', (10, 10), (255, 255, 255, 128))
+    )
+    Image.new('RGB', (40, 30)).save(os.path.join(root, 'photo.png'))
+    with open(os.path.join(root, 'broken.png'), 'wb') as f:
+        f.write(b'not an image')
+
+    response = client.get('/files/photo.png?watermark=true')
+    assert response.status_code == 200
+
+    monkeypatch.setitem(app.config, 'THUMBNAIL_MAX_DECODE_PIXELS', 1000)
+    response = client.get('/files/photo.png?watermark=true&wmAngle=30')
+    assert response.status_code == 400
+    assert 'too large' in response.json['message']
+
+    response = client.get('/files/broken.png?watermark=true')
+    assert response.status_code == 400
+    assert 'not an image' in response.json['message']